@@ -0,0 +1,134 @@
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+import data_store
+import registry
+from config import DATA_STORE_DIR
+from mapbox_cache import get_route_cache
+from route_network import bus_freq, bus_routes
+from density import bin_demand, departure_mask
+from route_demand import forecast_interval
+from timetable import DepartureIndex, Timetable, minutes_to_time
+from travel_times import load_bus_stops, load_travel_time_matrix
+
+CLOCK_TIMES = np.array([minutes_to_time(m) for m in range(24 * 60)], dtype=object) # datetime.time of every minute of the day
+
+
+class AppContext:
+    """
+    Datasets and route data used by the app, loaded on first use and then kept for the lifetime of the object.
+
+    Creating a context does no I/O, so scripts can import the optimization functions and pass a context without
+    starting the Streamlit UI. The app keeps a single context across reruns with st.cache_resource.
+    """
+
+    def __init__(self, synthetic_path='synthetic_data.csv', predicted_path='future_predicted_data.csv',
+                 stops_path='bus_stop_coords.csv', routes_path='cleaned_routes.csv', route_cache=None, store_dir=DATA_STORE_DIR):
+        self.synthetic_path = synthetic_path
+        self.predicted_path = predicted_path
+        self.store_dir = store_dir # typed Parquet copies of the CSVs, see data_store
+        self.routes_path = routes_path
+        self.stops_path = stops_path
+        self._route_cache = route_cache
+        self._route_data = {}
+        self._demand_counts = {}
+
+    @cached_property
+    def route_cache(self):
+        return self._route_cache if self._route_cache is not None else get_route_cache()
+
+    @cached_property
+    def bus_stops(self):
+        return load_bus_stops(self.stops_path)
+
+    @cached_property
+    def travel_times(self):
+        return load_travel_time_matrix(self.bus_stops, route_cache=self.route_cache)
+
+    def route_timing(self, route):
+        return self.travel_times.route_minutes(route) # total driving time in minutes
+
+    @cached_property
+    def route_times(self):
+        return {bus: self.route_timing(route) for bus, route in bus_routes.items()}
+
+    def bus_service_data(self, route_lst):
+        stops = self.bus_stops[self.bus_stops['Bus Stop'].isin(route_lst)]
+        route_df = pd.DataFrame({'Bus Stop': route_lst})
+        route_df['route_index'] = route_df.index
+        bus_df = route_df.merge(stops, on='Bus Stop', how='left')
+        bus_df.loc[bus_df['route_index']==0, 'color'] = 'red'
+        bus_df.loc[bus_df['route_index']!=0, 'color'] = 'blue'
+        bus_df.loc[bus_df['route_index']==bus_df.shape[0]-1, 'color'] = 'red'
+        bus_df.drop(columns='route_index', inplace=True)
+
+        return bus_df
+
+    def route_data(self, bus): # route data with travel times to the next stop and minutes from the terminal
+        if bus not in self._route_data:
+            bus_df = self.bus_service_data(bus_routes[bus])
+            leg_minutes = self.travel_times.route_leg_minutes(bus_routes[bus])
+            bus_df['duration_to_next'] = np.append(leg_minutes, np.nan)
+            bus_df['minutes_from_start'] = np.append(0, np.cumsum(leg_minutes))
+            self._route_data[bus] = bus_df
+
+        return self._route_data[bus]
+
+    @cached_property
+    def timetable(self):
+        # Departures of every service and stop as integer minutes, compiled once from bus_freq
+        return Timetable.compile(bus_freq, bus_routes, self.route_data)
+
+    @cached_property
+    def departure_index(self):
+        # Sorted departure minutes per (stop, service), for next-bus lookups
+        return DepartureIndex.from_timetable(self.timetable)
+
+    # Axes of the (stop x service x minute) arrays
+    @cached_property
+    def stops(self):
+        return list(self.bus_stops['Bus Stop'])
+
+    @cached_property
+    def services(self):
+        return list(bus_routes.keys())
+
+    @cached_property
+    def served_matrix(self):
+        # True where a service stops at a stop
+        return np.array([[stop in bus_routes[bus] for bus in self.services] for stop in self.stops])
+
+    @cached_property
+    def departure_mask(self):
+        return departure_mask(self.departure_index, self.stops, self.services)
+
+    def demand_counts(self, day):
+        # Predicted demand of a day binned per (stop, service, minute)
+        if day not in self._demand_counts:
+            demand = self.predicted_demand
+            self._demand_counts[day] = bin_demand(demand[demand['day_of_the_week'] == day], self.stops, self.services)
+
+        return self._demand_counts[day]
+
+    @cached_property
+    def demand_interval(self):
+        return forecast_interval(self.predicted_demand)
+
+    @cached_property
+    def trip_flows(self):
+        # Number of surveyed trips per (service, boarding stop, alighting stop)
+        routes = pd.read_csv(self.routes_path, usecols=['ISB_Service', 'bus_stop_board', 'bus_stop_alight'])
+        routes = registry.encode(routes)
+
+        return routes.groupby(['ISB_Service', 'bus_stop_board', 'bus_stop_alight'], observed=True).size().reset_index(name='count')
+
+    @cached_property
+    def predicted_demand(self):
+        predicted_demand = data_store.load(self.predicted_path, store_dir=self.store_dir)
+        predicted_demand['predicted_count'] = np.ceil(predicted_demand['predicted_count']).astype(np.int64)
+        predicted_demand['minute_of_day'] = predicted_demand['time_start'] # used by the engine
+        predicted_demand['time_start'] = CLOCK_TIMES[predicted_demand['minute_of_day'].to_numpy()]
+
+        return predicted_demand
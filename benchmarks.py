@@ -0,0 +1,178 @@
+# BENCHMARKS
+# Compares the array-based scoring code with the loops it replaced, on the datasets of an AppContext.
+# Usage: python benchmarks.py [day] [start HH:MM] [end HH:MM]
+
+import random
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import data_store
+from app_context import AppContext
+from bus_simulation import BusSimulation, sim_schedule
+from density import density_scores
+from optimization import buses_at_bus_stops, demand_for_day, generate_schedule, get_priority_score, get_satisfaction_scores
+from route_network import bus_routes
+from sim_engine import FastBusSimulation
+from timetable import minute_of_day, minutes_to_time
+
+
+# Previous implementation of get_density_scores: one DataFrame per stop, filled cell by cell
+def legacy_density_scores(ctx, bus_stop, demand_by_day, start_time, end_time, bus_dict=None):
+    if bus_dict is None:
+        bus_dict = buses_at_bus_stops(ctx.bus_stops)
+    buses = bus_dict[bus_stop]
+    time_range = pd.date_range(start=datetime.combine(datetime.today(), start_time), end=datetime.combine(datetime.today(), end_time), freq='1min').time
+    density_df = pd.DataFrame(0, index=time_range, columns=buses)
+    for bus in buses:
+        for t in density_df.index:
+            t_data = demand_by_day[(demand_by_day['time_start'] == t) & (demand_by_day['ISB_Service'] == bus)]
+            density_df.at[t, bus] += t_data.loc[t_data['bus_stop_board'] == bus_stop, 'predicted_count'].values[0]
+
+    for bus in buses:
+        schedule = [minutes_to_time(m) for m in generate_schedule(ctx, bus_stop, bus)]
+        cum_sum = 0
+        for t in density_df.index:
+            cum_sum += density_df.loc[t, bus]
+            if t in schedule:
+                cum_sum = 0
+            density_df.at[t, bus] = cum_sum
+
+    density_df = density_df.drop(columns=[col for col in ['K', 'E', 'BTC'] if col in density_df.columns], errors='ignore')
+
+    density_df['Total'] = density_df.sum(axis=1)
+
+    def assign_scores(total):
+        if 0 <= total <= 20:
+            return total * 1
+        elif 21 <= total <= 40:
+            return total * 2
+        elif 41 <= total <= 60:
+            return total * 3
+        elif 61 <= total <= 80:
+            return total * 4
+        elif 81 <= total <= 100:
+            return total * 5
+        else:
+            return total * 6
+
+    density_df['Score'] = density_df['Total'].apply(assign_scores)
+
+    return density_df
+
+
+# Previous implementation of get_satisfaction_scores: the stop's schedule rebuilt and scanned for every demand row
+def legacy_satisfaction_scores(ctx, day, start_time, end_time):
+    waittime_dict = {stop_name: {bus: 0 for bus in bus_routes.keys()} for stop_name in ctx.bus_stops['Bus Stop']}
+    demand_by_day = demand_for_day(ctx, day)
+    demand_by_day_time = demand_by_day[demand_by_day['time_start'].between(start_time, end_time)]
+    bus_stops_buses = buses_at_bus_stops(ctx.bus_stops)
+
+    def get_next_bus_time(curr_time, bus_stop, bus):
+        schedule = [minutes_to_time(m) for m in generate_schedule(ctx, bus_stop, bus)]
+        next_times = [bus_time for bus_time in schedule if bus_time >= curr_time]
+        return min(next_times) if next_times else None
+
+    def time_diff(time1, time2):
+        if time2 is None: # no bus after this time
+            return np.nan
+        dt_time1 = datetime.combine(datetime.today(), time1)
+        dt_time2 = datetime.combine(datetime.today(), time2)
+
+        return (dt_time2 - dt_time1).total_seconds() / 60
+
+    def get_entries(stop, bus):
+        entries = demand_by_day_time[(demand_by_day_time['ISB_Service']==bus) & (demand_by_day_time['bus_stop_board']==stop)].copy()
+        entries['next_bus'] = entries.apply(lambda r: get_next_bus_time(r['time_start'], r['bus_stop_board'], r['ISB_Service']), axis=1)
+        entries['minutes_to_next_bus'] = entries.apply(lambda r: time_diff(r['time_start'], r['next_bus']), axis=1)
+
+        return entries
+
+    for stop in bus_stops_buses.keys():
+        for bus in bus_stops_buses[stop]:
+            entries = get_entries(stop, bus)
+
+            total_waiting_time = (entries['predicted_count'] * entries['minutes_to_next_bus']).sum()
+            waittime_dict[stop][bus] = total_waiting_time
+
+    return waittime_dict
+
+
+def timed(fn, *args, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def bench_density(ctx, day, start_time, end_time):
+    def legacy_all_stops():
+        demand_by_day = demand_for_day(ctx, day)
+        bus_dict = buses_at_bus_stops(ctx.bus_stops)
+        return {stop: legacy_density_scores(ctx, stop, demand_by_day, start_time, end_time, bus_dict)['Score'].sum() for stop in ctx.stops}
+
+    ctx.demand_counts(day), ctx.departure_mask # build the cached arrays outside of the timings
+    legacy, legacy_time = timed(legacy_all_stops)
+    new, new_time = timed(density_scores, ctx, day, minute_of_day(start_time), minute_of_day(end_time), repeat=20)
+    assert all(np.isclose(legacy[stop], new[stop]) for stop in ctx.stops), 'density scores differ'
+    print(f'density scores, {len(ctx.stops)} stops: {legacy_time * 1000:.1f} ms -> {new_time * 1000:.2f} ms ({legacy_time / new_time:.0f}x)')
+
+
+def bench_scoring(ctx, day, start_time, end_time, repeat=20):
+    # Satisfaction and priority scores of an Optimize run, with the per-row schedule scan and with the departure index
+    start_minute, end_minute = minute_of_day(start_time), minute_of_day(end_time)
+    def legacy_pipeline():
+        return get_priority_score(ctx, legacy_satisfaction_scores(ctx, day, start_time, end_time), day, start_minute, end_minute)
+    def pipeline():
+        return get_priority_score(ctx, get_satisfaction_scores(ctx, day, start_minute, end_minute), day, start_minute, end_minute)
+
+    ctx.demand_counts(day), ctx.departure_mask
+    legacy, legacy_time = timed(legacy_pipeline)
+    new, new_time = timed(pipeline, repeat=repeat)
+    assert legacy.keys() == new.keys() and all(np.isclose(legacy[stop], new[stop]) for stop in legacy), 'priority scores differ'
+    print(f'scoring pipeline: {legacy_time * 1000:.1f} ms with per-row schedules -> {new_time * 1000:.1f} ms with the '
+          f'departure index ({legacy_time / new_time:.0f}x)')
+
+
+def bench_data_store(paths=('synthetic_data.csv', 'grouped_data.csv', 'future_predicted_data.csv')):
+    # Cold load of each dataset from CSV with its times parsed, against its typed Parquet file
+    def from_csv(path):
+        data = pd.read_csv(path)
+        data['time_start'] = pd.to_datetime(data['time_start'], format='mixed').dt.time
+        return data
+
+    for path in paths:
+        data_store.ensure(path) # convert outside of the timings
+        csv, csv_time = timed(from_csv, path)
+        parquet, parquet_time = timed(data_store.load, path)
+        print(f'{path}: {csv_time * 1000:.0f} ms, {csv.memory_usage(deep=True).sum() / 1e6:.1f} MB from CSV -> '
+              f'{parquet_time * 1000:.0f} ms, {parquet.memory_usage(deep=True).sum() / 1e6:.1f} MB from Parquet')
+
+
+def bench_simulation(ctx, bus, num_buses, replicas=1000):
+    bus_df, bus_schedule = ctx.route_data(bus), sim_schedule(bus)
+    simpy_sim = BusSimulation(bus_df, bus_schedule, num_buses, rng=random.Random(0))
+    _, simpy_time = timed(simpy_sim.run)
+    fast_sim = FastBusSimulation(bus_df, bus_schedule, num_buses)
+    _, fast_time = timed(fast_sim.run, random.Random(0))
+    assert simpy_sim.sim_log == fast_sim.sim_log, 'simulation logs differ'
+    _, replica_time = timed(fast_sim.run_replicas, replicas, 0)
+    print(f'simulation of {bus} with {num_buses} buses: SimPy {simpy_time * 1000:.1f} ms, fast engine {fast_time * 1000:.1f} ms, '
+          f'{replicas / replica_time:.0f} replicas/s')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    day = args[0] if args else 'Monday'
+    start_time = datetime.strptime(args[1] if len(args) > 1 else '08:00', '%H:%M').time()
+    end_time = datetime.strptime(args[2] if len(args) > 2 else '09:00', '%H:%M').time()
+
+    bench_data_store()
+    ctx = AppContext()
+    bench_density(ctx, day, start_time, end_time)
+    bench_scoring(ctx, day, start_time, end_time)
+    for bus in ctx.services:
+        bench_simulation(ctx, bus, 3)
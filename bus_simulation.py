@@ -0,0 +1,113 @@
+# SIMULATION
+# This simulation allows us to determine the minimum number of buses for each bus service required, so that every trip in the schedule will be fulfilled.
+
+import random
+
+import pandas as pd
+import simpy
+
+from event_log import DEPART, RETURN, STOP, EventLog
+from route_network import BUS_CAPACITY, bus_freq
+from timetable import band_departures, format_minutes, minute_of_day, minutes_to_time
+
+DAY_END = 23 * 60 + 59 # minute of the day at which the simulation stops
+
+
+def sim_schedule(bus_service, freq_dict=bus_freq):
+    # DF of the schedule created from create_schedule, with a column that has the minutes from the first bus
+    departures = band_departures(freq_dict[bus_service])
+    bus_schedule = pd.DataFrame({'depart_time': [minutes_to_time(m) for m in departures]})
+    bus_schedule['minutes_from_start'] = (departures - departures[0]).astype(float)
+
+    return bus_schedule
+
+
+class BusSimulation:
+    """Simulates one bus service for a day with num_buses buses leaving the terminal in turn."""
+
+    def __init__(self, bus_df, bus_schedule, num_buses, bus_capacity=BUS_CAPACITY, rng=random):
+        self.bus_df = bus_df # route data with travel times
+        self.rng = rng # random.Random to seed the simulation, the random module by default
+        self.bus_schedule = bus_schedule
+        self.bus_capacity = bus_capacity
+        self.queue_buses = [i+1 for i in range(num_buses)] # so that buses leave the terminal sequentially
+        self.passengers_served = 0
+
+        self.start_minute = minute_of_day(bus_schedule.loc[0, 'depart_time'])
+        self.events = EventLog(bus_df['Bus Stop'].tolist(), self.start_minute, capacity=len(bus_schedule) * (len(bus_df) + 2))
+        self.end_time = DAY_END - self.start_minute  # Calculate the number of minutes from the first bus to 2359hrs
+
+    def sim_time_to_actual(self, minutes):
+        return format_minutes(self.start_minute + minutes)
+
+    @property
+    def sim_log(self):
+        return self.events.render()
+
+    def bus_route(self, env, bus_id):
+        bus_df = self.bus_df
+        stop_index = 0
+        onboard = 0
+        while stop_index < len(bus_df):
+
+            stop = bus_df.iloc[stop_index]
+            travel_time = stop['duration_to_next']
+
+            # Alight passengers
+            if stop_index != len(bus_df) - 1:
+                num_alighting = self.rng.randint(0, onboard)
+                onboard -= num_alighting
+            else: # let all passengers alight
+                num_alighting = onboard
+                onboard = 0
+
+            # Board passengers
+            if stop_index != len(bus_df) - 1:
+                queue = self.rng.randint(0, 50) # replace with demand data
+                num_boarding = min(queue, self.bus_capacity - onboard)
+                queue -= num_boarding
+                onboard += num_boarding
+                self.passengers_served += num_boarding
+            else: # do not let passengers board
+                num_boarding = 0
+
+            self.events.record(env.now, bus_id, STOP, stop_index, num_boarding, num_alighting, onboard)
+
+            if pd.notna(travel_time):
+                yield env.timeout(travel_time)
+
+            stop_index += 1
+
+        return_to_terminal = 0
+        yield env.timeout(return_to_terminal)
+        self.events.record(env.now, bus_id, RETURN)
+        self.queue_buses.append(bus_id)
+
+    def bus_departure(self, env):
+        previous_time = 0
+        for _, row in self.bus_schedule.iterrows():
+            dept_time = row['minutes_from_start']
+            wait_time = dept_time - previous_time
+            yield env.timeout(wait_time)
+            previous_time = dept_time
+
+            if self.queue_buses: # empty buses are available for a trip
+                bus_id = self.queue_buses.pop(0)
+                self.events.record(env.now, bus_id, DEPART)
+
+                env.process(self.bus_route(env, bus_id))
+
+            else:
+                self.events.record(env.now, 0, DEPART)
+
+    def run(self):
+        env = simpy.Environment()
+
+        env.process(self.bus_departure(env))
+
+        env.run(until=self.end_time)
+
+        return self.events
+
+    def unavailable_count(self):
+        return self.events.missed_trips()
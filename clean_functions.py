@@ -13,6 +13,9 @@ import re
 import random
 from datetime import datetime, timedelta
 from collections import Counter
+from functools import lru_cache
+
+from route_network import RouteNetwork
 
 start_time = pd.to_datetime('07:00:00 AM', format='%I:%M:%S %p').time()
 end_time = pd.to_datetime('11:00:00 PM', format='%I:%M:%S %p').time()
@@ -46,25 +49,52 @@ def filter_days(day_of_trip, travel_days):
       # If travel_days is not a list or invalid, return None
       return None
 
+# Windows of a travel_hours answer such as '0800 - 1000, 1400 - 1600' as a (w x 2) array of start and end minutes of
+# the day. Answers repeat across thousands of rows, so each distinct one is parsed once
+@lru_cache(maxsize=None)
+def compile_travel_hours(travel_hours):
+    windows = np.array([[int(clock[:2]) * 60 + int(clock[2:]) for clock in time_range.split(' - ')]
+                        for time_range in travel_hours.split(', ')], dtype=np.int64)
+    windows.flags.writeable = False  # shared by every caller of the cache
+    return windows
+
+# Windows of every row in seconds of the day, padded with empty windows (start after end), and the number of windows
+# of each row; rows without travel_hours have none
+def travel_hours_windows(travel_hours):
+    codes, answers = pd.factorize(np.asarray(travel_hours, dtype=object))
+    compiled = [compile_travel_hours(answer) for answer in answers]
+    width = max([len(windows) for windows in compiled] + [1])
+    table = np.tile(np.array([1, 0], dtype=np.int64), (len(compiled) + 1, width, 1))
+    counts = np.zeros(len(compiled) + 1, dtype=np.int64)
+    for i, windows in enumerate(compiled):
+        table[i, :len(windows)] = windows * 60
+        counts[i] = len(windows)
+    return table[codes], counts[codes]
+
+# Seconds of the day of a column of times, NaN where missing
+def time_seconds(times):
+    codes, uniques = pd.factorize(np.asarray(times, dtype=object))
+    seconds = [t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1e6 for t in uniques]
+    return np.array(seconds + [np.nan])[codes]
+
+# Whether each time falls within one of the travel_hours windows of its row; missing times count as in range
+def times_in_range(travel_hours, times):
+    windows, _ = travel_hours_windows(travel_hours)
+    seconds = time_seconds(times)[:, None]
+    return ((windows[:, :, 0] <= seconds) & (seconds <= windows[:, :, 1])).any(axis=1) | np.isnan(seconds[:, 0])
+
 def check_time_in_range(travel_hours, actual_time):
     random.seed(2020)
     # Check if time_start is NaN
     if pd.isnull(actual_time):
         return None
 
-    # Split travel_hours into individual time ranges
-    time_ranges = travel_hours.split(', ')
-    valid_ranges = []
-    time_ranges = travel_hours.split(', ')  # Split string into individual time ranges
-
-    for time_range in time_ranges:
-        start_str, end_str = time_range.split(' - ')  # Split each range into start and end times
-        start_time = datetime.strptime(start_str, '%H%M').time()  # Convert to time object
-        end_time = datetime.strptime(end_str, '%H%M').time()  # Convert to time object
-        # Add to valid ranges list
-        valid_ranges.append((start_time, end_time))
+    # Windows of the answer as (start, end) times
+    valid_ranges = [tuple((datetime.min + timedelta(minutes=int(minutes))).time() for minutes in window)
+                    for window in compile_travel_hours(travel_hours)]
 
-        # Check if the actual_time falls within the current range
+    # Check if the actual_time falls within any of the ranges
+    for start_time, end_time in valid_ranges:
         if start_time <= actual_time <= end_time:
             return actual_time
 
@@ -78,6 +108,22 @@ def check_time_in_range(travel_hours, actual_time):
     random_time = (datetime.combine(datetime.today(), random_start) + timedelta(seconds=random_seconds)).time()
     return random_time
 
+# check_time_in_range for whole columns: times outside every travel_hours window of their row are replaced by a time
+# drawn uniformly from one of the windows, with draws from one generator so the result is the same for the same seed
+def check_times_in_range(travel_hours, times, seed=2020):
+    times = pd.Series(times)
+    windows, counts = travel_hours_windows(travel_hours)
+    redraw = np.flatnonzero(~times_in_range(travel_hours, times) & (counts > 0))
+
+    rng = np.random.default_rng(seed)
+    pick = (rng.random(len(redraw)) * counts[redraw]).astype(np.int64)
+    start, end = windows[redraw, pick, 0], windows[redraw, pick, 1]
+    seconds = (start + rng.integers(0, (end - start) % 86400 + 1)) % 86400
+
+    result = times.astype(object).where(times.notna(), None)
+    result.iloc[redraw] = [(datetime.min + timedelta(seconds=int(s))).time() for s in seconds]
+    return result
+
 # ADDITIONAL FEATURES
 # Function to convert integer to ordinal form
 def int_to_ordinal(rank):
@@ -104,42 +150,50 @@ def calculate_rank_distribution(data, columns):
         distribution[col] = dict(rank_counts)
     return distribution
 
-# Function to check for duplicate rankings and replace them based on other responses
-def check_ranking(row, distribution, ranks):
-    # Convert ranking values to integers
-    rankings = [int(rank[0]) if isinstance(rank, str) else rank for rank in row]
-
-    # Check if duplicates exist
-    duplicates = {rank for rank in rankings if rankings.count(rank) > 1}
-
-    # If duplicates are found, replace the row based on distribution
-    if duplicates:
-        used_ranks = set()
-        replacement_ranks = []
-
-        # Select unique ranks for each column
-        for col_name in row.index:
-            # Find the most frequent unused rank for the column
-            for rank in sorted(ranks, key=lambda r: distribution[col_name].get(r, 0), reverse=True):
-                if rank not in used_ranks:
-                    replacement_ranks.append(rank)
-                    used_ranks.add(rank)
-                    break
-
-        # Convert integers back to ordinal format
-        return [int_to_ordinal(rank) for rank in replacement_ranks]
-    else:
-        # If no duplicates, return the original row as ordinal values
-        return [int_to_ordinal(rank) for rank in rankings]
-
-# Apply the function to each group of rankings in the DataFrame
-def apply_rank_fix(data, columns, ranks):
-    # Calculate rank distribution based on existing data
-    rank_distribution = calculate_rank_distribution(data, columns)
-
-    # Apply the replace_with_unique_distribution function to rows
-    data[columns] = data[columns].apply(lambda row: check_ranking(
-        row, rank_distribution, ranks), axis=1, result_type='expand')
+# Rank numbers of a column (the leading digit of answers such as '2nd', numbers as they are) and the value the
+# cleaned column takes for each of them, both looked up once per distinct answer
+def parse_ranks(values):
+    codes, answers = pd.factorize(np.asarray(values, dtype=object))
+    rankings = [int(answer[0]) if isinstance(answer, str) else answer for answer in answers]
+    numbers = np.array([float(rank) for rank in rankings] + [np.nan])
+    ordinals = np.array([int_to_ordinal(rank) for rank in rankings] + [np.nan], dtype=object)
+    return numbers[codes], ordinals[codes]
+
+# Rows of an (n x k) matrix of rank numbers where a rank is repeated, counting two missing ranks as a repeat
+def duplicate_rank_rows(rankings):
+    ordered = np.sort(rankings, axis=1)
+    same = (ordered[:, 1:] == ordered[:, :-1]) | (np.isnan(ordered[:, 1:]) & np.isnan(ordered[:, :-1]))
+    return same.any(axis=1)
+
+# Ranks given to a row with duplicates: each column in turn takes the unused rank that is most frequent in it
+def replacement_ranks(columns, distribution, ranks):
+    used_ranks = set()
+    replacement = []
+    for col_name in columns:
+        for rank in sorted(ranks, key=lambda r: distribution[col_name].get(r, 0), reverse=True):
+            if rank not in used_ranks:
+                replacement.append(rank)
+                used_ranks.add(rank)
+                break
+    return replacement
+
+# Replace the rankings of every row with duplicate ranks, based on the other responses
+def apply_rank_fix(data, columns, ranks, rank_distribution=None):
+    # Calculate rank distribution based on existing data, unless it is given (e.g. counted over a whole export)
+    if rank_distribution is None:
+        rank_distribution = calculate_rank_distribution(data, columns)
+
+    parsed = [parse_ranks(data[col]) for col in columns]
+    rankings = np.column_stack([numbers for numbers, _ in parsed])
+    fixed = np.column_stack([ordinals for _, ordinals in parsed])
+
+    # The replacement only depends on the distribution, so all rows with duplicates get the same ranks, in ordinal format
+    replacement = [int_to_ordinal(rank) for rank in replacement_ranks(columns, rank_distribution, ranks)]
+    replacement += [np.nan] * (len(columns) - len(replacement)) # fewer ranks than columns
+    fixed[duplicate_rank_rows(rankings)] = replacement
+
+    for j, col in enumerate(columns):
+        data[col] = pd.Series(fixed[:, j], index=data.index, dtype=object)
     return data
 
 def update_trips(data):
@@ -166,106 +220,113 @@ def identify_na_rows_excluding_last_two(data):
     na_rows = data[data[columns_to_check].isna().any(axis=1)]
     return na_rows
 
-def validate_bus_stops(data, bus_routes):
-    for i in range(1, 4):  # Loop through each trip
-        service_col = f'ISB_Service_trip_{i}'
-        board_col = f'bus_stop_board_trip_{i}'
-        alight_col = f'bus_stop_alight_trip_{i}'
+# Answers that missing values of each column are drawn from: the counts of its non-null answers other than "No trip"
+def missing_value_pools(data, columns):
+    return {column: data[column][data[column] != "No trip"].value_counts(sort=False) for column in columns}
+
+# Replace missing values with answers drawn from the pools in proportion to their counts, as a random pick among the
+# non-null answers of the column would
+def fill_missing_values(data, pools, rng):
+    for column, counts in pools.items():
+        missing = data[column].isna().to_numpy()
+        if missing.any() and len(counts):
+            drawn = rng.choice(len(counts), size=int(missing.sum()), p=counts.to_numpy() / counts.sum())
+            data.loc[missing, column] = counts.index.to_numpy(dtype=object)[drawn]
+    return data
 
-        def check_stops(row):
-            random.seed(2020)
-            bus = row[service_col]
-            start = row[board_col]
-            end = row[alight_col]
-
-            # Check for "No trip"
-            if bus == "No trip":
-              return bus, start, end  # Return as is
-
-            # Get the route for the bus
-            route = bus_routes.get(bus, [])
-
-            if start in route and end in route:
-                start_index = route.index(start)
-                end_index = route.index(end) if end != route[0] else len(route)
-
-                if start_index < end_index and start != end:
-                    return bus, start, end  # No change if valid
-
-            # If only start is valid, randomly select an end stop from the route after start
-            if start in route:
-                start_index = route.index(start)
-                if start_index < len(route) - 1:  # Ensure there are stops after start
-                    possible_ends = route[start_index + 1:]
-                    new_end = np.random.choice(possible_ends)
-                    while new_end == start:
-                        new_end = np.random.choice(possible_ends)
-                    return bus, start, new_end
-
-            # If only end is valid, select a new start stop before end
-            if end in route:
-                end_index = route.index(end)
-                if end_index == 0:
-                    end_index = len(route) - 1  # If end is the first stop, assume it is the last stop (loop)
-                if end_index > 0:
-                    possible_starts = route[:end_index]
-                    new_start = np.random.choice(possible_starts)
-                    while new_start == end:
-                        new_start = np.random.choice(possible_starts)
-                    return bus, new_start, end
-
-            # Check for valid buses that have both start and end in the route
-            valid_buses = [
-                key for key, route in bus_routes.items()
-                if start in route and end in route and
-                (route.index(start) < route.index(end) or
-                 (route.index(end) == 0 and route.index(start) < len(route) - 1))
-            ]
-            if valid_buses:
-                new_bus = np.random.choice(valid_buses)  # Randomly choose one valid bus
-                return new_bus, start, end
-
-            # else, select two random stops in the correct order from the current bus route
-            random_start_index = np.random.randint(0, len(route) - 1)
-            random_end_index = np.random.randint(random_start_index + 1, len(route))
-            while random_start_index == 0 and random_end_index == len(route) - 1:
-                random_end_index = np.random.randint(random_start_index + 1, len(route))
-            new_start = route[random_start_index]
-            new_end = route[random_end_index]
-            return bus, new_start, new_end
-
-        data[[service_col, board_col, alight_col]] = data.apply(lambda row: check_stops(row), axis=1, result_type="expand")
+REPAIR_SEED = 2020
+
+def _pick(mask, rng):
+    # Column of a uniformly drawn True entry in every row of a boolean matrix; every row has at least one
+    draw = (rng.random(len(mask)) * mask.sum(axis=1)).astype(np.int64)
+    return np.argmax(np.cumsum(mask, axis=1) > draw[:, None], axis=1)
+
+def repair_trips(network, services, boards, alights, rng):
+    """
+    Repairs trips given as RouteNetwork codes and returns the new (service, board, alight) codes. Every trip falls
+    in one class, and each class is repaired with one vectorized draw from rng:
+    - valid: kept as it is
+    - start-only: the board stop is on the route with stops after it, so a new alight stop is drawn after it
+    - end-only: the alight stop is on the route, so a new board stop is drawn before it (before the end of the loop
+      when it is the first stop)
+    - wrong service: neither stop fits the route, but other services run the trip, so one of them is drawn
+    - neither: two stops are drawn in order on the route, other than the whole loop
+    Trips of services outside the network that no other service runs are kept as they are.
+    """
+    services, boards, alights = services.copy(), boards.copy(), alights.copy()
+    lengths = network.route_lengths[services]
+    start = network.stop_positions[services, boards]
+    end = network.stop_positions[services, alights]
+    others = network.valid[:-1, boards, alights].T # (trip x service)
+    columns = np.arange(network.route_codes.shape[1])
+
+    invalid = ~network.valid[services, boards, alights]
+    start_only = invalid & (start >= 0) & (start < lengths - 1)
+    end_only = invalid & ~start_only & (end >= 0)
+    wrong_service = invalid & ~start_only & ~end_only & others.any(axis=1)
+    neither = invalid & ~start_only & ~end_only & ~wrong_service & (services >= 0)
+
+    rows = np.flatnonzero(start_only)
+    route = network.route_codes[services[rows]]
+    after = (columns > start[rows, None]) & (columns < lengths[rows, None]) & (route != boards[rows, None])
+    alights[rows] = route[np.arange(len(rows)), _pick(after, rng)]
+
+    rows = np.flatnonzero(end_only)
+    route = network.route_codes[services[rows]]
+    last = np.where(end[rows] == 0, lengths[rows] - 1, end[rows]) # alighting at the first stop ends the loop
+    before = (columns < last[:, None]) & (route != alights[rows, None])
+    boards[rows] = route[np.arange(len(rows)), _pick(before, rng)]
+
+    rows = np.flatnonzero(wrong_service)
+    services[rows] = _pick(others[rows], rng)
+
+    rows = np.flatnonzero(neither)
+    route, length = network.route_codes[services[rows]], lengths[rows]
+    first = (rng.random(len(rows)) * (length - 1)).astype(np.int64)
+    latest = np.where(first == 0, length - 2, length - 1)
+    second = first + 1 + (rng.random(len(rows)) * (latest - first)).astype(np.int64)
+    boards[rows] = route[np.arange(len(rows)), first]
+    alights[rows] = route[np.arange(len(rows)), second]
+
+    return services, boards, alights
+
+def validate_bus_stops(data, bus_routes, seed=REPAIR_SEED):
+    """
+    Repairs the service and stops of every trip that cannot be ridden, with the rules of repair_trips. The three
+    trips are repaired in one pass, with draws from one generator, so the result is the same for the same seed.
+    """
+    network = RouteNetwork(bus_routes)
+    trips = [(f'ISB_Service_trip_{i}', f'bus_stop_board_trip_{i}', f'bus_stop_alight_trip_{i}') for i in range(1, 4)]
+
+    # All trips as one long column of each, trip 1 then trip 2 then trip 3
+    labels = [pd.concat([data[trip[j]] for trip in trips], ignore_index=True) for j in range(3)]
+    codes = network.codes(*labels)
+    rows = np.flatnonzero((labels[0] != "No trip").to_numpy())
+    repaired = repair_trips(network, *(c[rows] for c in codes), np.random.default_rng(seed))
+
+    names = [np.array(network.services, dtype=object), np.array(network.stops, dtype=object), np.array(network.stops, dtype=object)]
+    for j in range(3):
+        changed = repaired[j] != codes[j][rows]
+        trip, row = np.divmod(rows[changed], len(data))
+        for i, columns in enumerate(trips):
+            at = trip == i
+            data.iloc[row[at], data.columns.get_loc(columns[j])] = names[j][repaired[j][changed][at]]
 
     return data
 
 # Change bus_stop_board and bus_stop_alight to "error" if there is error in bus route
 def check_validate_bus_stops(data, bus_routes):
+    network = RouteNetwork(bus_routes)
     for i in range(1, 4):  # Loop through each trip
         service_col = f'ISB_Service_trip_{i}'
         board_col = f'bus_stop_board_trip_{i}'
         alight_col = f'bus_stop_alight_trip_{i}'
 
-        def check_stops(row):
-            bus = row[service_col]
-            start = row[board_col]
-            end = row[alight_col]
-
-            if bus == "No trip":
-              return row[board_col], row[alight_col]
+        # Valid if both stops are on the route and start is before end. Handle looping: a trip from the first stop
+        # back to the first stop rides the whole loop
+        services, boards, alights = network.codes(data[service_col], data[board_col], data[alight_col])
+        valid = network.valid[services, boards, alights] | ((boards >= 0) & (boards == alights) & (boards == network.first_stop[services]))
+        error = ~valid & (data[service_col] != "No trip").to_numpy()
+        data.loc[error, [board_col, alight_col]] = "error"
 
-            # Check if bus route exists in the dictionary
-            if bus in bus_routes:
-                route = bus_routes[bus]
-
-                # Check both stops are in the route and start is before end
-                if start in route and end in route:
-                    start_index = route.index(start)
-                    # Handle looping
-                    end_index = route.index(end) if end != route[0] else len(route)
-
-                    if start_index < end_index:
-                        return row[board_col], row[alight_col]  # No change if valid
-            return "error", "error"
-        data[[board_col, alight_col]] = data.apply(lambda row: check_stops(row), axis=1, result_type="expand")
-
-    return data
\ No newline at end of file
+    return data
@@ -0,0 +1,307 @@
+# CLEANING PIPELINE
+# The cleaning of data_cleaning.ipynb as a list of steps over clean_functions, from the survey export to the clean
+# data: renaming the columns, times moved into 07:00-23:00 and into the travel hours, trip days within the travel
+# days, rankings without repeats, "No trip" for unfilled trips, missing answers imputed and bus trips repaired.
+# Every step has a fingerprint made of the fingerprint of its input, its name, its parameters and its code, and its
+# output is checkpointed as a Parquet file named after that fingerprint. A run loads the last checkpoint that still
+# matches and runs only the steps after it, so a new export reruns everything, a changed step reruns itself and the
+# steps after it, and an unchanged pipeline only reads its final checkpoint.
+# Usage: python cleaning_pipeline.py [survey csv] [output csv]
+# The output defaults to data_store/clean_data.csv, so that a run never overwrites the tracked clean_data.csv, whose
+# random draws differ from the pipeline's.
+
+import hashlib
+import inspect
+import json
+import os
+import re
+import sys
+from datetime import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import clean_functions
+import data_store
+from clean_functions import (adjust_time_in_range, apply_rank_fix, check_times_in_range, filter_days,
+                             fill_missing_values, missing_value_pools, update_trips, validate_bus_stops)
+from config import CLEANING_CACHE_DIR, DATA_STORE_DIR
+from route_network import survey_routes
+
+PIPELINE_VERSION = '1' # bump when the checkpoint format changes, so that existing checkpoints are not reused
+CLEANING_SEED = 2020
+CLEANING_CODE = inspect.getsource(clean_functions) # part of every fingerprint, so a change to the functions reruns the steps
+
+# Survey questions and the column names they are cleaned into. The questions of trips 2 and 3 carry the suffixes
+# '.1' and '.2' that pandas gives repeated headers, and their columns the suffixes _trip_2 and _trip_3
+GENERAL_QUESTIONS = {
+    'Timestamp': 'timestamp',
+    'What is your role at the school?': 'role',
+    'How frequently do you use the public transport system (ISB) on campus? ': 'frequency_of_travel',
+    'What is your primary purpose for using the ISB on campus?': 'primary_purpose',
+    'Which days of the week do you use the ISB?': 'travel_days',
+    'At what times of the day do you travel using the ISB? (Please only choose the hours you would use the ISB)': 'travel_hours',
+}
+
+TRIP_QUESTIONS = {
+    'ISB Service used': 'ISB_Service',
+    'Where do you board the bus?': 'bus_stop_board',
+    'Where do you alight?': 'bus_stop_alight',
+    'What day of the week was this trip made?': 'day_of_the_week',
+    'What time do you typically start your journey?': 'time_start',
+    'What is your typical travel duration using the ISB?': 'travel_duration',
+    'Choose the column that best describes your satisfaction for each of the following.  [Frequency of buses]': 'frequency',
+    'Choose the column that best describes your satisfaction for each of the following.  [Punctuality of buses]': 'punctuality',
+    'Choose the column that best describes your satisfaction for each of the following.  [Cleanliness of buses]': 'cleanliness',
+    'Choose the column that best describes your satisfaction for each of the following.  [Safety on the buses]': 'safety',
+    'Choose the column that best describes your satisfaction for each of the following.  [Bus route coverage]': 'coverage',
+    'How crowded are the buses usually at this timing?': 'crowdedness',
+}
+
+PREFERENCE_QUESTIONS = {
+    'What influences your usage of the ISB over other forms of transportation? Rank each factor from 1st to 5th, 1st being the most important and 5th being the least important. (Please only choose one option for each column) [Convenience]': 'usage_influence_convenience',
+    'What influences your usage of the ISB over other forms of transportation? Rank each factor from 1st to 5th, 1st being the most important and 5th being the least important. (Please only choose one option for each column) [Cost]': 'usage_influence_cost',
+    'What influences your usage of the ISB over other forms of transportation? Rank each factor from 1st to 5th, 1st being the most important and 5th being the least important. (Please only choose one option for each column) [Lack of other transportation options]': 'usage_influence_lack_of_options',
+    'What influences your usage of the ISB over other forms of transportation? Rank each factor from 1st to 5th, 1st being the most important and 5th being the least important. (Please only choose one option for each column) [Availability of parking]': 'usage_influence_availability_of_parking',
+    'What influences your usage of the ISB over other forms of transportation? Rank each factor from 1st to 5th, 1st being the most important and 5th being the least important. (Please only choose one option for each column) [Environmental Concerns]': 'usage_influence_environmental',
+    'Rank the factors you prioritize the most when choosing a bus route from 1st to 6th, 1st being the most important and 6th being the least important. (Please only choose one option for each column) [Frequency of buses]': 'prioritize_frequency',
+    'Rank the factors you prioritize the most when choosing a bus route from 1st to 6th, 1st being the most important and 6th being the least important. (Please only choose one option for each column) [Punctuality of buses]': 'prioritize_punctuality',
+    'Rank the factors you prioritize the most when choosing a bus route from 1st to 6th, 1st being the most important and 6th being the least important. (Please only choose one option for each column) [Cleanliness of the buses]': 'prioritize_cleanliness',
+    'Rank the factors you prioritize the most when choosing a bus route from 1st to 6th, 1st being the most important and 6th being the least important. (Please only choose one option for each column) [Safety of the buses]': 'prioritize_safety',
+    'Rank the factors you prioritize the most when choosing a bus route from 1st to 6th, 1st being the most important and 6th being the least important. (Please only choose one option for each column) [Bus route coverage]': 'prioritize_bus_route_coverage',
+    'Rank the factors you prioritize the most when choosing a bus route from 1st to 6th, 1st being the most important and 6th being the least important. (Please only choose one option for each column) [Crowdedness of the bus]': 'prioritize_crowdedness',
+    'What are your top 3 frustrations with the ISB service?': 'top_3_frustrations',
+    'How often are you not able to get on the bus due to overcrowding?': 'not_able_to_get_on',
+    'What additional features would make the ISB more appealing to you?  Rank each factor from 1st to 6th, 1st being the most appealing and 6th being the least appealing. (Please only choose one option for each column) [More frequent bus services]': 'additional_features_frequency',
+    'What additional features would make the ISB more appealing to you?  Rank each factor from 1st to 6th, 1st being the most appealing and 6th being the least appealing. (Please only choose one option for each column) [More Seats]': 'additional_features_seats',
+    'What additional features would make the ISB more appealing to you?  Rank each factor from 1st to 6th, 1st being the most appealing and 6th being the least appealing. (Please only choose one option for each column) [Improved cleanliness]': 'additional_features_cleanliness',
+    'What additional features would make the ISB more appealing to you?  Rank each factor from 1st to 6th, 1st being the most appealing and 6th being the least appealing. (Please only choose one option for each column) [More comfortable seating]': 'additional_features_comfortable',
+    'What additional features would make the ISB more appealing to you?  Rank each factor from 1st to 6th, 1st being the most appealing and 6th being the least appealing. (Please only choose one option for each column) [Better route coverage]': 'additional_features_route_coverage',
+    'What additional features would make the ISB more appealing to you?  Rank each factor from 1st to 6th, 1st being the most appealing and 6th being the least appealing. (Please only choose one option for each column) [Real-time tracking and updates]': 'additional_features_updates',
+    'Have you faced issues with the quality of information provided about bus services (eg. timing accuracy, route changes)?': 'issues_with_quality_of_info',
+    'How well does the ISB accommodate special events (eg. Open House, exam season)?': 'special_events',
+    'Do you notice any seasonal changes in ISB quality and capacity?': 'seasonal_changes',
+    'Specify the seasonal changes in service identified from the previous question. ': 'seasonal_changes_specific',
+    'What changes would you like to see regarding the ISB system? (Enter NA if you do not wish to see any changes)': 'further_comments',
+}
+
+TRIP_COUNT = 3
+TIME_COLUMNS = [f'time_start_trip_{i}' for i in range(1, TRIP_COUNT + 1)]
+DAY_COLUMNS = [f'day_of_the_week_trip_{i}' for i in range(1, TRIP_COUNT + 1)]
+RANK_GROUPS = [
+    (['additional_features_frequency', 'additional_features_seats', 'additional_features_cleanliness',
+      'additional_features_comfortable', 'additional_features_route_coverage', 'additional_features_updates'], 6),
+    (['prioritize_frequency', 'prioritize_punctuality', 'prioritize_cleanliness',
+      'prioritize_safety', 'prioritize_bus_route_coverage', 'prioritize_crowdedness'], 6),
+    (['usage_influence_convenience', 'usage_influence_cost', 'usage_influence_lack_of_options',
+      'usage_influence_availability_of_parking', 'usage_influence_environmental'], 5)
+]
+FREE_TEXT_COLUMNS = ['seasonal_changes_specific', 'further_comments'] # the last two columns, never imputed
+
+
+# Steps. Each takes the frame and its parameters and returns the cleaned frame
+
+def rename_survey_columns(data, general, trip, preferences, trips):
+    columns = dict(general)
+    for i in range(1, trips + 1):
+        suffix = '' if i == 1 else f'.{i - 1}'
+        columns.update({question + suffix: f'{name}_trip_{i}' for question, name in trip.items()})
+    columns.update(preferences)
+    return data.rename(columns=columns)
+
+
+def adjust_trip_times(data, columns, time_format):
+    # Times as datetime.time, with AM and PM swapped where that brings them into 07:00-23:00; each distinct time is
+    # adjusted once
+    for column in columns:
+        codes, uniques = pd.factorize(pd.to_datetime(data[column], format=time_format))
+        adjusted = np.array([adjust_time_in_range(value) for value in uniques] + [None], dtype=object)
+        data[column] = pd.Series(adjusted[codes], index=data.index, dtype=object)
+    return data
+
+
+def split_days(value):
+    # Missing answers as NaN, as read_csv gives them, also when they come from Parquet as None
+    return np.nan if pd.isnull(value) else [day.strip() for day in re.split(', |/ ', value)]
+
+
+def join_days(value):
+    return value if not isinstance(value, list) and pd.isnull(value) else ', '.join(map(str, value))
+
+
+def filter_trip_days(data, columns, travel_days):
+    # Keeps the days of each trip that are among the travel days, or picks one of the travel days. filter_days seeds
+    # its own draw, so its result only depends on the two answers and is worked out once for each distinct pair
+    filtered = {}
+    for column in columns:
+        trips = []
+        for pair in zip(data[column].to_numpy(dtype=object), data[travel_days].to_numpy(dtype=object)):
+            if pair not in filtered:
+                filtered[pair] = join_days(filter_days(split_days(pair[0]), split_days(pair[1])))
+            trips.append(filtered[pair])
+        data[column] = trips
+    data[travel_days] = data[travel_days].apply(split_days).apply(join_days)
+    return data
+
+
+def check_trip_times(data, columns, travel_hours, seed):
+    for column in columns:
+        data[column] = check_times_in_range(data[travel_hours], data[column], seed=seed)
+    return data
+
+
+def fix_rankings(data, groups, distribution=None):
+    # distribution: answer counts of every rank column, counted over this frame unless given
+    for columns, n_ranks in groups:
+        data = apply_rank_fix(data, columns, set(range(1, n_ranks + 1)), distribution)
+    return data
+
+
+def impute_missing(data, exclude, seed, pools=None):
+    # Missing answers drawn from the other answers of their column, or from the given pools
+    if pools is None:
+        pools = missing_value_pools(data, [column for column in data.columns if column not in exclude])
+    return fill_missing_values(data, pools, np.random.default_rng(seed))
+
+
+class Step:
+    """One step of a pipeline: a function of the frame, with the keyword parameters it is called with."""
+
+    def __init__(self, name, function, **params):
+        self.name = name
+        self.function = function
+        self.params = params
+
+    def fingerprint(self, upstream):
+        # SHA-256 of the input fingerprint, the name, the parameters and the code of the step and of clean_functions
+        digest = hashlib.sha256()
+        for part in (PIPELINE_VERSION, upstream, self.name, json.dumps(self.params, sort_keys=True, default=repr),
+                     inspect.getsource(self.function), CLEANING_CODE):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def __call__(self, data):
+        return self.function(data, **self.params)
+
+
+SURVEY_STEPS = [
+    Step('rename', rename_survey_columns, general=GENERAL_QUESTIONS, trip=TRIP_QUESTIONS,
+         preferences=PREFERENCE_QUESTIONS, trips=TRIP_COUNT),
+    Step('adjust_times', adjust_trip_times, columns=TIME_COLUMNS, time_format='%I:%M:%S %p'),
+    Step('filter_days', filter_trip_days, columns=DAY_COLUMNS, travel_days='travel_days'),
+    Step('check_times', check_trip_times, columns=TIME_COLUMNS, travel_hours='travel_hours', seed=CLEANING_SEED),
+    Step('rank_fix', fix_rankings, groups=RANK_GROUPS),
+    Step('update_trips', update_trips),
+    Step('impute', impute_missing, exclude=FREE_TEXT_COLUMNS, seed=CLEANING_SEED),
+    Step('validate_bus_stops', validate_bus_stops, bus_routes=survey_routes, seed=CLEANING_SEED),
+]
+
+
+# Checkpoints. Text columns of the survey mix strings with times, numbers and missing values ("No trip" next to
+# 08:15), which Parquet cannot hold in one typed column, so object columns are stored as tagged strings:
+# 's' text, 'i' integer, 'f' float, 'n' NaN, 't' time, 'b' boolean and null for None
+
+def _encode(value):
+    if isinstance(value, str):
+        return 's' + value
+    if isinstance(value, (bool, np.bool_)):
+        return 'b' + str(bool(value))
+    if isinstance(value, (int, np.integer)):
+        return 'i' + str(int(value))
+    if isinstance(value, (float, np.floating)):
+        return 'n' if np.isnan(value) else 'f' + repr(float(value))
+    if isinstance(value, time):
+        return 't' + value.isoformat()
+    if value is None:
+        return None
+    raise TypeError(f'Cannot checkpoint a value of type {type(value).__name__}: {value!r}')
+
+
+def _decode(tagged):
+    tag, text = tagged[0], tagged[1:]
+    if tag == 's':
+        return text
+    if tag == 'b':
+        return text == 'True'
+    if tag == 'i':
+        return int(text)
+    if tag == 'f':
+        return float(text)
+    if tag == 'n':
+        return np.nan
+    return time.fromisoformat(text)
+
+
+def tag_columns(data, columns):
+    # Copy of the frame with the columns as tagged strings
+    data = data.copy()
+    for column in columns:
+        # Value by value: factorize would merge None with NaN and 1 with 1.0 and True
+        data[column] = [_encode(value) for value in data[column].to_numpy(dtype=object)]
+    return data
+
+
+def tagged_table(data, tagged, schema=None, preserve_index=None):
+    # Arrow table of a frame with its tagged columns listed in the schema metadata, for read_checkpoint
+    table = pa.Table.from_pandas(tag_columns(data, tagged), schema=schema, preserve_index=preserve_index)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'tagged_columns'] = json.dumps(tagged).encode()
+    return table.replace_schema_metadata(metadata)
+
+
+def write_checkpoint(data, path):
+    table = tagged_table(data, [column for column in data.columns if data[column].dtype == object])
+
+    partial = path + '.tmp' # readers never see a half-written file
+    pq.write_table(table, partial)
+    os.replace(partial, path)
+
+
+def read_checkpoint(path):
+    table = pq.read_table(path)
+    data = table.to_pandas()
+    for column in json.loads(table.schema.metadata[b'tagged_columns']):
+        codes, uniques = pd.factorize(data[column].to_numpy(dtype=object)) # the tags keep distinct values apart
+        lookup = np.array([_decode(value) for value in uniques] + [None], dtype=object)
+        data[column] = pd.Series(lookup[codes], index=data.index, dtype=object)
+    return data
+
+
+def checkpoint_path(cache_dir, position, step, fingerprint):
+    return os.path.join(cache_dir, f'{position:02d}_{step.name}_{fingerprint[:16]}.parquet')
+
+
+def run_pipeline(csv_path, steps=SURVEY_STEPS, cache_dir=CLEANING_CACHE_DIR):
+    """
+    Cleans a survey export with the steps in order and returns the clean frame. The output of every step is
+    checkpointed in cache_dir; steps whose fingerprint has a checkpoint are not run again. The names of the steps that
+    ran are in data.attrs['steps_run'].
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprints, upstream = [], data_store.file_hash(csv_path)
+    for step in steps:
+        upstream = step.fingerprint(upstream)
+        fingerprints.append(upstream)
+    paths = [checkpoint_path(cache_dir, i, step, fingerprint) for i, (step, fingerprint) in enumerate(zip(steps, fingerprints))]
+
+    # Resume after the last step whose output is checkpointed
+    done = max([i + 1 for i, path in enumerate(paths) if os.path.exists(path)], default=0)
+    data = read_checkpoint(paths[done - 1]) if done else pd.read_csv(csv_path)
+    for step, path in zip(steps[done:], paths[done:]):
+        data = step(data)
+        write_checkpoint(data, path)
+
+    data.attrs['steps_run'] = [step.name for step in steps[done:]]
+    return data
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else 'form_responses.csv'
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.join(DATA_STORE_DIR, 'clean_data.csv')
+    clean = run_pipeline(source)
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    clean.to_csv(target, index=False)
+    print(f'{source} -> {target} ({len(clean)} rows, ran: {", ".join(clean.attrs["steps_run"]) or "nothing, all steps cached"})')
@@ -0,0 +1,22 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+MAPBOX_API = os.getenv("MAPBOX_API")
+
+# Mapbox responses are cached on disk so that reruns of the Streamlit app do not hit the API again
+ROUTE_CACHE_PATH = os.getenv("ROUTE_CACHE_PATH", "route_cache.sqlite")
+ROUTE_CACHE_TTL_DAYS = float(os.getenv("ROUTE_CACHE_TTL_DAYS", "30"))
+ROUTE_CACHE_MAX_ENTRIES = int(os.getenv("ROUTE_CACHE_MAX_ENTRIES", "5000"))
+MAPBOX_OFFLINE = os.getenv("MAPBOX_OFFLINE", "0").lower() in ("1", "true", "yes") # never call the API, only serve from the cache
+
+# Stop-to-stop travel time matrix, built once from the Mapbox Matrix API (or a straight-line estimate) and saved as .npy
+TRAVEL_TIME_MATRIX_PATH = os.getenv("TRAVEL_TIME_MATRIX_PATH", "travel_time_matrix.npy")
+
+# Typed Parquet copies of the CSV datasets, rebuilt when a CSV changes
+DATA_STORE_DIR = os.getenv("DATA_STORE_DIR", "data_store")
+
+# Parquet checkpoints of the steps of the cleaning pipeline
+CLEANING_CACHE_DIR = os.getenv("CLEANING_CACHE_DIR", os.path.join(DATA_STORE_DIR, "cleaning"))
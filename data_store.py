@@ -0,0 +1,123 @@
+# DATA STORE
+# The project's CSVs converted once into typed Parquet files. Service, stop and day columns are stored as categoricals
+# with the normalised names and codes of the registry, role and any other text column whose values repeat as plain
+# categoricals, times as integer minutes of the day, and integer columns are downcast.
+# Every file records the SHA-256 of the CSV it was built from and is rebuilt when the CSV changes. Loaders read only
+# the columns and rows asked for, so a Monday of the forecast does not parse the rest of the week.
+# Usage: python data_store.py [csv ...]
+
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import registry
+from config import DATA_STORE_DIR
+
+STORE_VERSION = '2' # bump when the conversion changes, so that existing files are rebuilt
+CATEGORICAL_PREFIXES = ('role',)
+TIME_PREFIXES = ('time_start',)
+CLOCK = re.compile(r'(\d{1,2}):(\d{2})(?::\d{2}(?:\.\d+)?)?\s*$') # HH:MM[:SS], after a date or on its own
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def store_path(csv_path, store_dir=DATA_STORE_DIR):
+    return os.path.join(store_dir, os.path.splitext(os.path.basename(csv_path))[0] + '.parquet')
+
+
+def clock_minutes(values):
+    # Time strings such as '07:45:00' or '2024-09-01 07:45:00' to minutes of the day, <NA> where missing
+    parts = pd.Series(values, dtype='string').str.extract(CLOCK)
+    minutes = pd.to_numeric(parts[0]) * 60 + pd.to_numeric(parts[1])
+    minutes = minutes.astype('Int16')
+
+    return minutes.astype(np.int16) if not minutes.hasnans else minutes
+
+
+def _matches(column, prefixes):
+    return any(column == prefix or column.startswith(prefix + '_') for prefix in prefixes)
+
+
+def to_columnar(data):
+    """
+    Types a frame read from CSV: registry categoricals for services, stops and days, categoricals for roles and for
+    repetitive text such as the survey answers, time columns as minutes of the day and integer columns downcast to the
+    smallest type that holds them.
+    """
+    data = data.copy()
+    for column in data.columns:
+        if _matches(column, TIME_PREFIXES):
+            data[column] = clock_minutes(data[column])
+        elif registry.column_kind(column) is not None:
+            data[column] = pd.Series(registry.categorical(data[column], registry.column_kind(column)), index=data.index)
+        elif _matches(column, CATEGORICAL_PREFIXES):
+            data[column] = data[column].astype('category')
+        elif data[column].dtype == object and data[column].nunique() <= len(data) // 2:
+            data[column] = data[column].astype('category')
+        elif pd.api.types.is_integer_dtype(data[column]):
+            data[column] = pd.to_numeric(data[column], downcast='integer')
+
+    return data
+
+
+def convert(csv_path, parquet_path=None, source_hash=None):
+    # Writes the typed Parquet file of a CSV, with the hash of the CSV in the file metadata
+    parquet_path = parquet_path or store_path(csv_path)
+    os.makedirs(os.path.dirname(parquet_path) or '.', exist_ok=True)
+    table = pa.Table.from_pandas(to_columnar(pd.read_csv(csv_path)), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata.update({b'source': os.path.basename(csv_path).encode(), b'store_version': STORE_VERSION.encode(),
+                     b'source_sha256': (source_hash or file_hash(csv_path)).encode()})
+
+    partial = parquet_path + '.tmp' # readers never see a half-written file
+    pq.write_table(table.replace_schema_metadata(metadata), partial)
+    os.replace(partial, parquet_path)
+
+    return parquet_path
+
+
+def is_stale(csv_path, parquet_path, source_hash=None):
+    if not os.path.exists(parquet_path):
+        return True
+    metadata = pq.read_schema(parquet_path).metadata or {}
+    return (metadata.get(b'store_version') != STORE_VERSION.encode() or
+            metadata.get(b'source_sha256') != (source_hash or file_hash(csv_path)).encode())
+
+
+def ensure(csv_path, store_dir=DATA_STORE_DIR):
+    # Path of the Parquet file of a CSV, converting it first if it is missing or out of date
+    parquet_path = store_path(csv_path, store_dir)
+    source_hash = file_hash(csv_path)
+    if is_stale(csv_path, parquet_path, source_hash):
+        convert(csv_path, parquet_path, source_hash)
+
+    return parquet_path
+
+
+def load(csv_path, columns=None, filters=None, store_dir=DATA_STORE_DIR):
+    """
+    Reads a CSV through its Parquet file. columns selects the columns to read and filters the rows, in the pyarrow
+    form [(column, op, value), ...], e.g. [('day_of_the_week', '==', 'Monday')]; both are applied while reading.
+    Categorical columns keep the categories of the whole file.
+    """
+    table = pq.read_table(ensure(csv_path, store_dir), columns=columns, filters=filters)
+    return table.to_pandas()
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or ['synthetic_data.csv', 'grouped_data.csv', 'future_predicted_data.csv']:
+        if os.path.exists(path):
+            print(f'{path} -> {ensure(path)}')
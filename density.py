@@ -0,0 +1,83 @@
+# DENSITY SCORES
+# Number of passengers left waiting at each stop minute by minute, accumulated until the next bus of each service
+# arrives. Demand is binned into a (stop x service x minute) array once per day, and all stops are scored together.
+
+import numpy as np
+
+import registry
+
+MINUTES_PER_DAY = 24 * 60
+EXCLUDED_SERVICES = ['K', 'E', 'BTC'] # not counted towards the density of a stop
+SCORE_BANDS = [(0, 20, 1), (21, 40, 2), (41, 60, 3), (61, 80, 4), (81, 100, 5)] # (low, high, multiplier), otherwise 6
+
+
+def bin_demand(demand, stops, services):
+    # Sum of predicted_count per (stop, service, minute of day); rows with unknown stops or services are ignored
+    stop_codes = registry.positions(demand['bus_stop_board'], stops, 'stop')
+    service_codes = registry.positions(demand['ISB_Service'], services, 'service')
+    minutes = demand['minute_of_day'].to_numpy(dtype=np.int64) % MINUTES_PER_DAY
+    valid = (stop_codes >= 0) & (service_codes >= 0)
+
+    flat = (stop_codes[valid] * len(services) + service_codes[valid]) * MINUTES_PER_DAY + minutes[valid]
+    counts = np.bincount(flat, weights=demand['predicted_count'].to_numpy()[valid],
+                         minlength=len(stops) * len(services) * MINUTES_PER_DAY)
+
+    return counts.reshape(len(stops), len(services), MINUTES_PER_DAY)
+
+
+def departure_mask(departure_index, stops, services):
+    # True at the minutes of the day at which a service leaves a stop
+    mask = np.zeros((len(stops), len(services), MINUTES_PER_DAY), dtype=bool)
+    for i, stop in enumerate(stops):
+        for j, bus in enumerate(services):
+            if (stop, bus) in departure_index.departures:
+                mask[i, j, departure_index.stop_departures(stop, bus) % MINUTES_PER_DAY] = True
+
+    return mask
+
+
+def waiting_counts(counts, resets):
+    """
+    Running total of counts along the last axis that goes back to zero wherever resets is True, i.e. the number of
+    passengers that have arrived since the last bus. Computed as a cumulative sum minus its value at the last reset.
+    """
+    cum = np.cumsum(counts, axis=-1)
+    positions = np.arange(counts.shape[-1])
+    last_reset = np.maximum.accumulate(np.where(resets, positions, -1), axis=-1)
+    base = np.take_along_axis(cum, np.maximum(last_reset, 0), axis=-1)
+
+    return cum - np.where(last_reset >= 0, base, 0)
+
+
+def assign_scores(totals):
+    # Weight the number of waiting passengers by how crowded the stop is
+    multiplier = np.full(np.shape(totals), 6)
+    for low, high, weight in reversed(SCORE_BANDS):
+        multiplier = np.where((totals >= low) & (totals <= high), weight, multiplier)
+
+    return totals * multiplier
+
+
+def window_minutes(start_minute, end_minute):
+    return np.arange(start_minute, end_minute + 1)
+
+
+def density_tensor(counts, resets, served, services, start_minute, end_minute):
+    """
+    Returns (window, waiting, totals): the minutes of the window, the (stop x service x minute) waiting counts for
+    services that serve each stop, and the per-stop totals over the services that count towards the density score.
+    """
+    window = window_minutes(start_minute, end_minute)
+    waiting = waiting_counts(counts[:, :, window], resets[:, :, window]) * served[:, :, None]
+    counted = np.array([bus not in EXCLUDED_SERVICES for bus in services])
+    totals = waiting[:, counted, :].sum(axis=1)
+
+    return window, waiting, totals
+
+
+def density_scores(ctx, day, start_minute, end_minute):
+    # Density score of every stop for the day and time window (minutes of the day), summed over the minutes of the window
+    _, _, totals = density_tensor(ctx.demand_counts(day), ctx.departure_mask, ctx.served_matrix, ctx.services, start_minute, end_minute)
+    scores = assign_scores(totals).sum(axis=1)
+
+    return dict(zip(ctx.stops, scores))
@@ -0,0 +1,139 @@
+# EVENT LOG
+# Typed record of a simulated day. Every departure, stop visit and return to the terminal is one row in preallocated
+# NumPy columns, so counts and loads can be queried directly. The text shown in the app is only built on request.
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from timetable import format_minutes
+
+DEPART, STOP, RETURN = 0, 1, 2 # event types
+EVENT_NAMES = ['depart', 'stop', 'return']
+COLUMNS = {'time': np.float64, 'bus_id': np.int16, 'stop_idx': np.int16, 'event_type': np.int8,
+           'board': np.int32, 'alight': np.int32, 'onboard': np.int32}
+
+
+class EventLog:
+    """
+    Columns of simulation events: time in minutes from the first departure, bus_id (0 when no bus was available for
+    a departure), stop_idx on the route (-1 for departures and returns), event_type, and the passengers that board,
+    alight and are onboard after boarding at stop events.
+    """
+
+    def __init__(self, stop_names, start_minute, capacity=1024):
+        self.stop_names = stop_names
+        self.start_minute = start_minute # minute of the day of time 0
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.size = 0
+
+    @classmethod
+    def from_columns(cls, stop_names, start_minute, **columns):
+        # Wraps complete columns, e.g. from a replayed plan, without copying them row by row
+        log = cls(stop_names, start_minute, capacity=0)
+        size = len(columns['time'])
+        log.columns = {name: np.asarray(columns[name], dtype=dtype) if name in columns else np.zeros(size, dtype=dtype)
+                       for name, dtype in COLUMNS.items()}
+        log.size = size
+
+        return log
+
+    def record(self, time, bus_id, event_type, stop_idx=-1, board=0, alight=0, onboard=0):
+        if self.size == len(self.columns['time']): # double the columns when full
+            for name, column in self.columns.items():
+                self.columns[name] = np.concatenate([column, np.zeros(max(len(column), 1), dtype=column.dtype)])
+        i = self.size
+        row = {'time': time, 'bus_id': bus_id, 'stop_idx': stop_idx, 'event_type': event_type,
+               'board': board, 'alight': alight, 'onboard': onboard}
+        for name, value in row.items():
+            self.columns[name][i] = value
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.columns[name][:self.size]
+
+    # Aggregate queries
+
+    def missed_trips(self):
+        return int(((self['event_type'] == DEPART) & (self['bus_id'] == 0)).sum())
+
+    def passengers_served(self):
+        return int(self['board'].sum())
+
+    def peak_load(self):
+        return int(self['onboard'].max(initial=0))
+
+    def stop_totals(self):
+        # Bus visits, boardings and alightings per stop of the route
+        stops = self['event_type'] == STOP
+        stop_idx = self['stop_idx'][stops]
+        n = len(self.stop_names)
+        return pd.DataFrame({'Bus Stop': self.stop_names,
+                             'visits': np.bincount(stop_idx, minlength=n),
+                             'board': np.bincount(stop_idx, weights=self['board'][stops], minlength=n).astype(int),
+                             'alight': np.bincount(stop_idx, weights=self['alight'][stops], minlength=n).astype(int)})
+
+    def stop_waits(self):
+        """
+        Mean headway between buses at each stop, and the mean wait of a passenger arriving at a random time between
+        the first and the last bus, which is the sum of the squared headways over twice their total.
+        """
+        stops = self['event_type'] == STOP
+        stop_idx, times = self['stop_idx'][stops], self['time'][stops]
+        order = np.lexsort((times, stop_idx))
+        stop_idx, times = stop_idx[order], times[order]
+        same_stop = stop_idx[1:] == stop_idx[:-1]
+        gaps, gap_stop = np.diff(times)[same_stop], stop_idx[1:][same_stop]
+
+        n = len(self.stop_names)
+        count = np.bincount(gap_stop, minlength=n)
+        total = np.bincount(gap_stop, weights=gaps, minlength=n)
+        squared = np.bincount(gap_stop, weights=gaps ** 2, minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.DataFrame({'Bus Stop': self.stop_names,
+                                 'mean_headway': total / count,
+                                 'mean_wait': squared / (2 * total)})
+
+    # Export and rendering
+
+    def to_frame(self):
+        frame = pd.DataFrame({name: self[name] for name in COLUMNS})
+        frame['event_type'] = pd.Categorical.from_codes(frame['event_type'], EVENT_NAMES)
+        return frame
+
+    def to_parquet(self, path):
+        table = pa.table({name: self[name] for name in COLUMNS})
+        table = table.replace_schema_metadata({'stop_names': '\n'.join(self.stop_names),
+                                               'start_minute': str(self.start_minute)})
+        pq.write_table(table, path)
+
+    def clock_times(self):
+        # HH:MM of every event, formatting each distinct time once
+        times, inverse = np.unique(self['time'], return_inverse=True)
+        labels = [format_minutes(self.start_minute + t) for t in times]
+        return [labels[i] for i in inverse]
+
+    def render(self):
+        # The log lines of the app, in the same wording as the original simulation
+        lines = []
+        columns = [self[name].tolist() for name in ('bus_id', 'stop_idx', 'event_type', 'board', 'alight', 'onboard')]
+        for clock, bus_id, stop, kind, board, alight, onboard in zip(self.clock_times(), *columns):
+            if kind == STOP:
+                stop_name = self.stop_names[stop]
+                if stop != 0:
+                    lines.append(f"Bus {bus_id} reaches {stop_name} at {clock}")
+                lines.append(f"Bus {bus_id} at {stop_name}: {alight} alight, {onboard - board} onboard")
+                lines.append(f"Bus {bus_id} at {stop_name}: {board} board, {onboard} onboard")
+            elif kind == DEPART:
+                if bus_id:
+                    lines.append(f"Bus {bus_id} departs at {clock}")
+                else:
+                    lines.append(f"No bus available for scheduled departure at {clock}")
+            else:
+                lines.append(f"Bus {bus_id} returns to the terminal at {clock}")
+
+        return lines
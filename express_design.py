@@ -0,0 +1,197 @@
+# EXPRESS ROUTE DESIGN
+# Searches stop sets and orders for an express loop with simulated annealing over the stop-to-stop travel-time matrix.
+# A design is worth the waiting time it saves passengers at its stops, for the trips that it can take them on, minus
+# the bus time it takes to run. Everything is scored from arrays, so the search runs offline, one restart per process.
+
+import math
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import registry
+from route_network import bus_routes
+from route_demand import network_stops
+
+EXPRESS_HEADWAY = 10 # minutes between express buses
+VEHICLE_COST = 1.0 # passenger-minutes of waiting that one minute of bus time is worth
+
+
+class ExpressProblem:
+    """
+    Candidate stops with their passengers in the time window, the mean wait for the existing services, the share of
+    trips from each stop to each other stop, and the leg minutes between stops.
+    """
+
+    def __init__(self, stops, passengers, waits, shares, legs, headway=EXPRESS_HEADWAY, window=60, vehicle_cost=VEHICLE_COST):
+        self.stops = stops
+        self.passengers = passengers
+        self.waits = waits
+        self.shares = shares
+        self.legs = legs
+        self.headway = headway
+        self.window = window # minutes the express runs for
+        self.vehicle_cost = vehicle_cost
+        # Waiting time saved per passenger when the express also calls at the stop, with waits for both taken as
+        # exponential so that their rates add up
+        with np.errstate(divide='ignore'):
+            combined = 1 / (1 / waits + 2 / headway)
+        self.saved = np.where(waits > 0, waits - combined, 0)
+
+    @classmethod
+    def from_context(cls, ctx, day, start_minute, end_minute, headway=EXPRESS_HEADWAY, vehicle_cost=VEHICLE_COST, routes=bus_routes):
+        stops = [stop for stop in network_stops(routes) if stop in ctx.travel_times and stop in ctx.stops]
+        index = {stop: i for i, stop in enumerate(stops)}
+
+        # Passengers and the minutes they wait for the next bus of their service in the window
+        demand = ctx.predicted_demand
+        demand = demand[(demand['day_of_the_week'] == day) & demand['minute_of_day'].between(start_minute, end_minute)]
+        demand = demand[demand['bus_stop_board'].isin(index)]
+        _, minutes_to_next_bus = ctx.departure_index.lookup(demand['bus_stop_board'], demand['ISB_Service'],
+                                                            demand['minute_of_day'].to_numpy())
+        served = ~np.isnan(minutes_to_next_bus)
+        codes = registry.positions(demand['bus_stop_board'], stops, 'stop')[served] # through the category codes
+        counts = demand['predicted_count'].to_numpy(dtype=float)[served]
+        passengers = np.bincount(codes, weights=counts, minlength=len(stops))
+        waiting = np.bincount(codes, weights=counts * minutes_to_next_bus[served], minlength=len(stops))
+        waits = np.divide(waiting, passengers, out=np.zeros(len(stops)), where=passengers > 0)
+
+        # Where passengers from each stop travel to, from the survey trips of all services
+        trips = np.zeros((len(stops), len(stops)))
+        flows = ctx.trip_flows.groupby(['bus_stop_board', 'bus_stop_alight'], observed=True)['count'].sum()
+        for (board, alight), count in flows.items():
+            if board in index and alight in index and board != alight:
+                trips[index[board], index[alight]] += count
+        no_trips = trips.sum(axis=1) == 0
+        trips[no_trips] = 1 - np.eye(len(stops))[no_trips]
+        shares = trips / trips.sum(axis=1, keepdims=True)
+
+        idx = ctx.travel_times.stop_indices(stops)
+        legs = np.ceil(ctx.travel_times.seconds[np.ix_(idx, idx)] / 60) + 1
+
+        return cls(stops, passengers, waits, shares, legs, headway, max(end_minute - start_minute, 1), vehicle_cost)
+
+    def cycle_minutes(self, route):
+        # Minutes for a bus to run the loop once, back to its first stop
+        return float(self.legs[route, np.roll(route, -1)].sum())
+
+    def score(self, route):
+        """Returns (objective, wait_saved, bus_minutes) of an express loop through the stops at the route indices."""
+        route = np.asarray(route)
+        riders = self.passengers[route] * self.shares[np.ix_(route, route)].sum(axis=1)
+        wait_saved = float((riders * self.saved[route]).sum())
+        bus_minutes = self.cycle_minutes(route) * self.window / self.headway
+        return wait_saved - self.vehicle_cost * bus_minutes, wait_saved, bus_minutes
+
+
+def _loop_moves(route):
+    # Every loop one 2-opt move (reversing a segment) or or-opt move (moving one stop) away, keeping the first stop
+    n = len(route)
+    for i in range(1, n - 1):
+        for j in range(i + 1, n):
+            yield route[:i] + route[i:j + 1][::-1] + route[j + 1:]
+    for k in range(1, n):
+        rest = route[:k] + route[k + 1:]
+        for m in range(1, n):
+            if m != k:
+                yield rest[:m] + [route[k]] + rest[m:]
+
+
+def two_opt(route, legs, max_passes=50):
+    """
+    Shortens the loop with 2-opt and or-opt moves. Driving times are asymmetric, so a reversed segment also changes the
+    time of every leg inside it: each move is scored by the length of the whole loop, the best one is taken while it
+    makes the loop shorter, and the search stops after max_passes moves.
+    """
+    def length(loop):
+        loop = np.asarray(loop)
+        return float(legs[loop, np.roll(loop, -1)].sum())
+
+    route = list(route)
+    current = length(route)
+    for _ in range(max_passes):
+        best = min(_loop_moves(route), key=length, default=None)
+        if best is None or length(best) >= current:
+            break
+        route, current = best, length(best)
+
+    return route
+
+
+def _neighbour(route, n_stops, min_stops, max_stops, rng):
+    # Adds, drops or swaps a stop, or moves stops within the loop (2-opt and or-opt moves)
+    route = list(route)
+    outside = [s for s in range(n_stops) if s not in route]
+    move = rng.randrange(5)
+    if move == 0 and len(route) < max_stops and outside:
+        route.insert(rng.randrange(len(route) + 1), rng.choice(outside))
+    elif move == 1 and len(route) > min_stops:
+        route.pop(rng.randrange(len(route)))
+    elif move == 2 and outside:
+        route[rng.randrange(len(route))] = rng.choice(outside)
+    elif move == 3 and len(route) > 2:
+        i, j = sorted(rng.sample(range(len(route)), 2))
+        route[i:j + 1] = reversed(route[i:j + 1])
+    elif len(route) > 2:
+        stop = route.pop(rng.randrange(len(route)))
+        route.insert(rng.randrange(len(route) + 1), stop)
+
+    return route
+
+
+def anneal(task):
+    """
+    One simulated annealing run from a random loop of min_stops stops. Returns the best route (as stop indices), its
+    score and the number of candidate designs scored.
+    """
+    problem, seed, iterations, min_stops, max_stops = task
+    rng = random.Random(seed)
+    n_stops = len(problem.stops)
+    route = rng.sample(range(n_stops), min_stops)
+    current = problem.score(route)[0]
+    best_route, best = route, current
+    temperature = 0.1 * abs(current) + 1
+    cooling = (1e-3) ** (1 / iterations)
+
+    for _ in range(iterations):
+        candidate = _neighbour(route, n_stops, min_stops, max_stops, rng)
+        value = problem.score(candidate)[0]
+        if value >= current or rng.random() < math.exp((value - current) / temperature):
+            route, current = candidate, value
+            if value > best:
+                best_route, best = candidate, value
+        temperature *= cooling
+
+    shortened = two_opt(best_route, problem.legs)
+    if problem.score(shortened)[0] > best: # keep the annealed route unless the shorter loop scores better
+        best_route, best = shortened, problem.score(shortened)[0]
+    return best_route, best, iterations + 1
+
+
+def design_express_route(problem, restarts=8, iterations=3000, min_stops=2, max_stops=6, seed=0, processes=None):
+    """
+    Runs independent annealing restarts, in parallel unless processes is 1, and returns the distinct designs found
+    as a DataFrame sorted from best to worst, with the stops in calling order and the parts of the objective.
+    """
+    seeds = np.random.SeedSequence(seed).generate_state(restarts)
+    tasks = [(problem, int(s), iterations, min_stops, max_stops) for s in seeds]
+    if processes == 1:
+        results = list(map(anneal, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(anneal, tasks))
+
+    designs = {}
+    for route, _, _ in results:
+        designs[frozenset(route)] = route
+    rows = []
+    for route in designs.values():
+        objective, wait_saved, bus_minutes = problem.score(route)
+        rows.append({'stops': [problem.stops[s] for s in route], 'objective': objective, 'wait_saved': wait_saved,
+                     'bus_minutes': bus_minutes, 'cycle_minutes': problem.cycle_minutes(np.array(route)),
+                     'buses': math.ceil(problem.cycle_minutes(np.array(route)) / problem.headway)})
+
+    designs = pd.DataFrame(rows).sort_values('objective', ascending=False).reset_index(drop=True)
+    designs.attrs['candidates_scored'] = sum(scored for _, _, scored in results)
+    return designs
@@ -0,0 +1,163 @@
+# FLEET SIZING
+# Monte Carlo search for the smallest number of buses that runs a service's timetable. Each fleet size is simulated
+# over many seeded days, optionally with random travel times, on a process pool. With random travel times, building
+# the plan of a day is the expensive part, so replicas share a bounded number of travel time draws and only draw their
+# passengers separately.
+
+import hashlib
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from route_network import bus_freq
+from sim_engine import build_plan, demand_loads, replica_loads
+
+_sweeps = {} # results of previous sweeps, keyed by a hash of their inputs
+CHUNK_SIZE = 50 # replicas per task sent to a worker
+TIMING_DRAWS = 40 # travel time draws (plans built) per fleet size when travel times are random
+
+
+def min_headway(freq_dict, bus):
+    # Shortest time between departures in the timetable, in minutes
+    return min(int(band[2].rstrip('min')) for band in freq_dict[bus].values())
+
+
+def fleet_sizes(freq_dict, bus, cycle_minutes, margin=2):
+    # From one bus up to enough buses to run the most frequent band without waiting, plus a margin
+    return list(range(1, math.ceil(cycle_minutes / min_headway(freq_dict, bus)) + margin + 1))
+
+
+def _simulate_fleet(task):
+    # Runs the replicas of one fleet size, given as groups of seeds that share a travel time draw; called in worker
+    # processes. Returns the missed departures of every travel time draw and the loads of every replica
+    legs, departures, end_time, num_buses, bus_capacity, groups, travel_time_cv, demand = task
+    n_stops = len(legs) + 1
+
+    def loads_for(plan, n, rng):
+        if demand is not None:
+            return demand_loads(plan, demand, bus_capacity, n, rng)
+        return replica_loads(plan, n_stops, bus_capacity, n, rng)
+
+    if travel_time_cv == 0: # every day has the same timing, so all replicas share one plan
+        seeds = [seed for group in groups for seed in group]
+        plan = build_plan(departures, legs, num_buses, end_time)
+        loads = loads_for(plan, len(seeds), np.random.default_rng(seeds[0]))
+        return num_buses, np.array([plan.missed_trips]), loads['passengers_served'], loads['peak_load']
+
+    missed, served, peak = [], [], []
+    for group in groups:
+        rng = np.random.default_rng(group[0])
+        # Mean-preserving lognormal noise on every leg of every trip
+        noise = rng.lognormal(-travel_time_cv ** 2 / 2, travel_time_cv, size=(len(departures), len(legs)))
+        plan = build_plan(departures, legs * noise, num_buses, end_time)
+        loads = loads_for(plan, len(group), rng)
+        missed.append(plan.missed_trips), served.append(loads['passengers_served']), peak.append(loads['peak_load'])
+
+    return num_buses, np.array(missed), np.concatenate(served), np.concatenate(peak)
+
+
+def _sweep_key(*args):
+    digest = hashlib.sha1()
+    for arg in args:
+        digest.update(arg.tobytes() if isinstance(arg, np.ndarray) else repr(arg).encode())
+    return digest.hexdigest()
+
+
+def _run_tasks(tasks, processes=None, pool=None):
+    if pool is not None:
+        return list(pool.map(_simulate_fleet, tasks))
+    if processes == 1:
+        return list(map(_simulate_fleet, tasks))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_simulate_fleet, tasks))
+
+
+def _seed_tasks(seeds, n_groups):
+    # Splits the seeds of one fleet size into n_groups groups of consecutive seeds, packed into tasks of about
+    # CHUNK_SIZE replicas
+    tasks, task = [], []
+    for group in np.array_split(np.arange(len(seeds)), n_groups):
+        task.append([seeds[i] for i in group])
+        if sum(len(g) for g in task) >= CHUNK_SIZE:
+            tasks.append(task)
+            task = []
+    if task:
+        tasks.append(task)
+
+    return tasks
+
+
+def sweep_fleet(simulation, sizes, replicas=200, seed=0, travel_time_cv=0.1, target_service_level=1.0, confidence=0.95,
+                processes=None, pool=None, timing_draws=TIMING_DRAWS):
+    """
+    Simulates every fleet size in sizes for the route, timetable and demand of a FastBusSimulation.
+
+    Returns (summary, min_fleet): a DataFrame with the distribution of missed departures and passenger loads per
+    fleet size, and the smallest fleet for which at least `confidence` of the travel time draws run at least
+    `target_service_level` of the scheduled departures (None if no fleet size does). Replicas are split into tasks
+    for a process pool; pass pool to reuse an executor across calls.
+
+    Which departures get a bus only depends on the travel times, not on the passengers. With travel_time_cv > 0, every
+    fleet size builds min(replicas, timing_draws) plans from independent travel time draws, each shared by an equal
+    share of the replicas with their own passengers, and the missed departures and service level are taken over
+    those draws. Without variability there is a single draw. Replicas add passenger draws, and so precision to the
+    loads, but not to the fleet decision.
+    """
+    sizes = list(sizes)
+    legs, departures, demand = simulation.legs, simulation.plan.trip_departure, simulation.demand
+    demand_key = (demand.arrivals, demand.destinations, demand.start_minute) if demand is not None else (None,)
+    key = _sweep_key(legs, departures, simulation.end_time, simulation.bus_capacity, sizes, replicas, seed,
+                     travel_time_cv, target_service_level, confidence, timing_draws, *demand_key)
+    if key in _sweeps:
+        return _sweeps[key]
+
+    tasks = []
+    for num_buses, seed_seq in zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))):
+        seeds = seed_seq.spawn(replicas)
+        n_groups = replicas if travel_time_cv == 0 else min(replicas, timing_draws)
+        for groups in _seed_tasks(seeds, n_groups):
+            tasks.append((legs, departures, simulation.end_time, num_buses, simulation.bus_capacity, groups, travel_time_cv, demand))
+
+    results = {}
+    for num_buses, missed, served, peak in _run_tasks(tasks, processes, pool):
+        results.setdefault(num_buses, []).append((missed, served, peak))
+
+    rows = []
+    for num_buses in sizes:
+        missed, served, peak = (np.concatenate(arrays) for arrays in zip(*results[num_buses]))
+        if travel_time_cv == 0:
+            missed = missed[:1] # every task ran the same plan
+        service_level = 1 - missed / len(departures)
+        rows.append({'num_buses': num_buses,
+                     'timing_draws': len(missed),
+                     'missed_mean': missed.mean(),
+                     'missed_p50': np.percentile(missed, 50),
+                     'missed_p95': np.percentile(missed, 95),
+                     'missed_max': missed.max(),
+                     'service_level_mean': service_level.mean(),
+                     'meets_target': (service_level >= target_service_level).mean(),
+                     'passengers_served_mean': served.mean(),
+                     'peak_load_mean': peak.mean(),
+                     'peak_load_p95': np.percentile(peak, 95)})
+    summary = pd.DataFrame(rows)
+
+    meets = summary.loc[summary['meets_target'] >= confidence, 'num_buses']
+    min_fleet = int(meets.min()) if len(meets) else None
+    _sweeps[key] = (summary, min_fleet)
+
+    return summary, min_fleet
+
+
+def sweep_services(simulations, replicas=200, seed=0, travel_time_cv=0.1, target_service_level=1.0, confidence=0.95,
+                   processes=None, freq_dict=bus_freq, timing_draws=TIMING_DRAWS):
+    # Sweeps every service in simulations (service -> FastBusSimulation) over the fleet sizes its timetable needs
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for bus, simulation in simulations.items():
+            sizes = fleet_sizes(freq_dict, bus, simulation.legs.sum())
+            results[bus] = sweep_fleet(simulation, sizes, replicas, seed, travel_time_cv, target_service_level, confidence,
+                                       pool=pool, timing_draws=timing_draws)
+
+    return results
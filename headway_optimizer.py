@@ -0,0 +1,111 @@
+# HEADWAY AND FLEET OPTIMIZATION
+# Mixed-integer program that picks a headway for every service and time band of the timetable, together with the
+# size of the fleet, trading passenger waiting time against the cost of running buses. Solved offline with HiGHS
+# through scipy.optimize.milp.
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import Bounds, LinearConstraint, milp
+
+from route_demand import spread_counts
+from route_network import BUS_CAPACITY, bus_freq
+
+HEADWAYS = (3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 15, 20, 30, 45) # candidate minutes between buses
+# Costs in passenger-minutes of waiting
+BUS_COST = 300.0 # per bus in the fleet for the day
+BUS_HOUR_COST = 60.0 # per hour that a bus is in service
+
+
+def to_minutes(clock):
+    hour, minute = clock.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def band_demand(counts, bands):
+    """
+    Passengers per (service, band) from a (service x minute) array: the total over the band and the largest number in
+    any 15 minutes of the band, which bounds how many passengers the buses of that quarter hour have to carry.
+    """
+    cum = np.concatenate([np.zeros((counts.shape[0], 1)), np.cumsum(counts, axis=1)], axis=1)
+    quarter = cum[:, 15:] - cum[:, :-15] # passengers in the 15 minutes from each minute
+    totals, peaks = [], []
+    for service, start, end in bands:
+        totals.append(cum[service, end] - cum[service, start])
+        peaks.append(quarter[service, start:max(end - 15, start) + 1].max())
+
+    return np.array(totals), np.array(peaks)
+
+
+def optimize_headways(ctx, day, headways=HEADWAYS, bus_cost=BUS_COST, bus_hour_cost=BUS_HOUR_COST, max_fleet=None,
+                      layover=0, bus_capacity=BUS_CAPACITY, freq_dict=bus_freq):
+    """
+    Chooses one headway per service and time band of freq_dict for the predicted demand of a day, and the smallest
+    fleet that runs them. Passengers wait half a headway on average. In every band the buses of a quarter hour must
+    have room for the peak quarter-hour demand. A service needs one bus per headway of its turnaround time, the
+    minutes of its route in route_data (the legs the simulator runs, with a minute at each stop) plus layover, and the
+    fleet must cover all services running at the same time.
+
+    Returns (plan, fleet, timetable): a DataFrame with the chosen headway, buses and waiting time of every band, the
+    fleet size, and the headways in the format of bus_freq for create_schedule and the simulator.
+    """
+    services = [bus for bus in freq_dict if bus in ctx.services]
+    counts = spread_counts(ctx.demand_counts(day).sum(axis=0), ctx.demand_interval) # (service x minute)
+    bands = [(bus, to_minutes(start), to_minutes(end)) for bus in services for start, end, _ in freq_dict[bus].values()]
+    totals, peaks = band_demand(counts, [(ctx.services.index(bus), start, end) for bus, start, end in bands])
+
+    headways = np.array(headways, dtype=float)
+    n_bands, n_headways = len(bands), len(headways)
+    turnaround = {bus: ctx.route_data(bus)['minutes_from_start'].iloc[-1] for bus in services}
+    cycle = np.array([turnaround[bus] + layover for bus, _, _ in bands], dtype=float)
+    buses = np.ceil(cycle[:, None] / headways[None, :]) # buses each headway needs in each band
+    hours = np.array([(end - start) / 60 for _, start, end in bands])
+    room = bus_capacity * 15 / headways # places per quarter hour
+    feasible = room[None, :] >= peaks[:, None]
+    if not feasible.any(axis=1).all():
+        bus, start, end = bands[int(np.flatnonzero(~feasible.any(axis=1))[0])]
+        raise ValueError(f'No headway in {tuple(headways)} carries the peak demand of {bus} between '
+                         f'{start // 60:02d}:{start % 60:02d} and {end // 60:02d}:{end % 60:02d}')
+
+    # Variables: one binary per (band, headway), then the fleet size
+    cost = totals[:, None] * headways[None, :] / 2 + bus_hour_cost * buses * hours[:, None]
+    c = np.append(cost.ravel(), bus_cost)
+    n_vars = len(c)
+
+    one_headway = np.zeros((n_bands, n_vars))
+    for i in range(n_bands):
+        one_headway[i, i * n_headways:(i + 1) * n_headways] = 1
+
+    # The fleet covers the buses of every band that runs in each period between band boundaries
+    edges = np.unique([minute for _, start, end in bands for minute in (start, end)])
+    periods = [(a, b) for a, b in zip(edges[:-1], edges[1:])]
+    fleet_rows = np.zeros((len(periods), n_vars))
+    for p, (a, b) in enumerate(periods):
+        for i, (_, start, end) in enumerate(bands):
+            if start < b and a < end:
+                fleet_rows[p, i * n_headways:(i + 1) * n_headways] = -buses[i]
+        fleet_rows[p, -1] = 1
+
+    upper = np.append(feasible.ravel().astype(float), np.inf if max_fleet is None else max_fleet)
+    result = milp(c, integrality=np.ones(n_vars), bounds=Bounds(np.zeros(n_vars), upper),
+                  constraints=[LinearConstraint(one_headway, 1, 1), LinearConstraint(fleet_rows, 0, np.inf)])
+    if not result.success:
+        raise ValueError(f'Headway optimization failed: {result.message}')
+
+    choice = result.x[:-1].reshape(n_bands, n_headways).argmax(axis=1)
+    rows = np.arange(n_bands)
+    plan = pd.DataFrame({'ISB_Service': [bus for bus, _, _ in bands],
+                         'start': [f'{start // 60:02d}:{start % 60:02d}' for _, start, _ in bands],
+                         'end': [f'{end // 60:02d}:{end % 60:02d}' for _, _, end in bands],
+                         'headway': headways[choice].astype(int),
+                         'buses': buses[rows, choice].astype(int),
+                         'passengers': totals,
+                         'peak_quarter_hour': peaks,
+                         'wait_minutes': totals * headways[choice] / 2})
+    fleet = int(round(result.x[-1]))
+
+    timetable = {}
+    for bus, band in plan.groupby('ISB_Service', sort=False):
+        timetable[bus] = {i: [start, end, f'{headway}min'] for i, (start, end, headway)
+                          in enumerate(zip(band['start'], band['end'], band['headway']))}
+
+    return plan, fleet, timetable
@@ -0,0 +1,199 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+import polyline
+import requests
+
+from config import MAPBOX_API, ROUTE_CACHE_PATH, ROUTE_CACHE_TTL_DAYS, ROUTE_CACHE_MAX_ENTRIES, MAPBOX_OFFLINE
+
+DIRECTIONS_URL = 'https://api.mapbox.com/directions/v5/mapbox/{profile}/{coords}?alternatives=false&geometries=geojson&language=en&overview=full&steps=true&access_token={token}'
+MATRIX_URL = 'https://api.mapbox.com/directions-matrix/v1/mapbox/{profile}/{coords}?sources={sources}&destinations={destinations}&annotations=duration&access_token={token}'
+OPTIMIZED_TRIPS_URL = 'https://api.mapbox.com/optimized-trips/v1/mapbox/{profile}/{coords}?roundtrip=false&source=first&destination=last&approaches={approaches}&steps=true&access_token={token}'
+
+
+class RouteCacheMiss(LookupError):
+    """Raised in offline mode when a request is not in the cache."""
+
+
+def cache_key(kind, profile, coords):
+    # coords is an ordered list of (lon, lat) pairs, rounded so that float noise does not create new keys
+    return f"{kind}/{profile}/" + ';'.join(f"{lon:.6f},{lat:.6f}" for lon, lat in coords)
+
+
+def _coords_param(coords):
+    return ';'.join(f"{lon},{lat}" for lon, lat in coords)
+
+
+class RouteCache:
+    """
+    Disk-backed cache of Mapbox Directions and Optimized Trips responses.
+
+    Only the parts of a response that the app uses are kept (leg durations and distances, and the geometry as an
+    encoded polyline), compressed with zlib in a single SQLite file. Entries older than the TTL are refetched when
+    online and served as-is when offline; the least recently used entries are evicted past max_entries.
+    """
+
+    def __init__(self, path=ROUTE_CACHE_PATH, ttl_days=ROUTE_CACHE_TTL_DAYS, max_entries=ROUTE_CACHE_MAX_ENTRIES,
+                 offline=MAPBOX_OFFLINE, access_token=MAPBOX_API, session=None):
+        self.path = path
+        self.ttl = ttl_days * 24 * 3600
+        self.max_entries = max_entries
+        self.offline = offline
+        self.access_token = access_token
+        self.session = session or requests.Session()
+        self.network_calls = 0
+        self._memory = {} # key -> (created, payload)
+        self._used = set() # keys read since the last eviction, for LRU bookkeeping
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, created REAL, last_used REAL, payload BLOB)')
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM routes').fetchone()[0]
+
+    # Storage
+    def _is_fresh(self, created):
+        return self.ttl <= 0 or time.time() - created < self.ttl
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                created, payload = self._memory[key]
+            else:
+                row = self._conn.execute('SELECT created, payload FROM routes WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                created, payload = row[0], json.loads(zlib.decompress(row[1]))
+                self._memory[key] = (created, payload)
+            self._used.add(key)
+
+        if self._is_fresh(created) or self.offline:
+            return payload
+        return None
+
+    def put(self, key, payload):
+        now = time.time()
+        blob = zlib.compress(json.dumps(payload, separators=(',', ':')).encode())
+        with self._lock:
+            self._memory[key] = (now, payload)
+            self._conn.execute('INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)', (key, now, now, blob))
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        # Drop expired entries, then the least recently used ones until the cache fits in max_entries
+        with self._lock:
+            now = time.time()
+            self._conn.executemany('UPDATE routes SET last_used = ? WHERE key = ?', [(now, k) for k in self._used])
+            self._used.clear()
+            if self.ttl > 0 and not self.offline:
+                self._conn.execute('DELETE FROM routes WHERE created < ?', (now - self.ttl,))
+            if self.max_entries:
+                self._conn.execute('DELETE FROM routes WHERE key NOT IN (SELECT key FROM routes ORDER BY last_used DESC LIMIT ?)',
+                                   (self.max_entries,))
+            self._conn.commit()
+            keys = {row[0] for row in self._conn.execute('SELECT key FROM routes')}
+            self._memory = {k: v for k, v in self._memory.items() if k in keys}
+
+    def preload(self):
+        # Load the whole cache into memory so that lookups during a page render never touch the disk
+        with self._lock:
+            rows = self._conn.execute('SELECT key, created, payload FROM routes').fetchall()
+            for key, created, blob in rows:
+                self._memory[key] = (created, json.loads(zlib.decompress(blob)))
+        return len(rows)
+
+    # Fetching
+    def _fetch(self, key, url):
+        if self.offline:
+            raise RouteCacheMiss(f"{key} is not cached and MAPBOX_OFFLINE is set")
+        self.network_calls += 1
+        response = self.session.get(url)
+        return response.json()
+
+    def directions(self, coords, profile='driving'):
+        """
+        Returns {'durations': [...], 'distances': [...], 'geometry': [(lat, lon), ...]} for the route through coords
+        (a list of (lon, lat) pairs), one duration/distance in seconds/metres per leg. Returns None if Mapbox has no route.
+        """
+        key = cache_key('directions', profile, coords)
+        payload = self.get(key)
+        if payload is None:
+            url = DIRECTIONS_URL.format(profile=profile, coords=_coords_param(coords), token=self.access_token)
+            route_data = self._fetch(key, url)
+            if 'routes' not in route_data or len(route_data['routes']) == 0:
+                return None
+            route = route_data['routes'][0]
+            geometry = [(lat, lon) for lon, lat in route['geometry']['coordinates']]
+            payload = {'durations': [leg['duration'] for leg in route['legs']],
+                       'distances': [leg['distance'] for leg in route['legs']],
+                       'geometry': polyline.encode(geometry, 6)}
+            self.put(key, payload)
+
+        return {'durations': payload['durations'],
+                'distances': payload['distances'],
+                'geometry': polyline.decode(payload['geometry'], 6)}
+
+    def matrix(self, coords, sources, destinations, profile='driving'):
+        """
+        Returns the len(sources) x len(destinations) list of driving durations in seconds between coords (indices
+        into the list of (lon, lat) pairs), with None where Mapbox has no route.
+        """
+        key = cache_key('matrix', profile, coords) + '/' + ','.join(map(str, sources)) + '/' + ','.join(map(str, destinations))
+        payload = self.get(key)
+        if payload is None:
+            url = MATRIX_URL.format(profile=profile, coords=_coords_param(coords), sources=';'.join(map(str, sources)),
+                                    destinations=';'.join(map(str, destinations)), token=self.access_token)
+            matrix_data = self._fetch(key, url)
+            if 'durations' not in matrix_data:
+                return None
+            payload = {'durations': matrix_data['durations']}
+            self.put(key, payload)
+
+        return payload['durations']
+
+    def optimized_trip(self, coords, profile='driving', approach='curb'):
+        """
+        Returns {'geometry': [(lat, lon), ...], 'waypoints': [((lat, lon), waypoint_index), ...]} for the optimized
+        trip through coords, keeping the first and last coordinates fixed.
+        """
+        key = cache_key('optimized-trips', profile, coords)
+        payload = self.get(key)
+        if payload is None:
+            approaches = ';'.join([approach] * len(coords))
+            url = OPTIMIZED_TRIPS_URL.format(profile=profile, coords=_coords_param(coords), approaches=approaches,
+                                             token=self.access_token)
+            directions = self._fetch(key, url)
+            if 'trips' not in directions or len(directions['trips']) == 0:
+                return None
+            payload = {'geometry': directions['trips'][0]['geometry'],
+                       'waypoints': [[wp['location'][1], wp['location'][0], wp['waypoint_index']] for wp in directions['waypoints']]}
+            self.put(key, payload)
+
+        return {'geometry': polyline.decode(payload['geometry']),
+                'waypoints': [((lat, lon), idx) for lat, lon, idx in payload['waypoints']]}
+
+    def warm(self, coord_lists, profile='driving', pairwise=True):
+        # Fetch every route (and optionally every consecutive pair of stops) up front, e.g. before going offline
+        for coords in coord_lists:
+            self.directions(coords, profile)
+            if pairwise:
+                for i in range(len(coords) - 1):
+                    self.directions(coords[i:i + 2], profile)
+        return self.network_calls
+
+
+_default_cache = None
+
+def get_route_cache():
+    # One cache per process, preloaded on first use
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = RouteCache()
+        _default_cache.preload()
+    return _default_cache
@@ -0,0 +1,223 @@
+# NETWORK SIMULATION
+# All services in one event loop. Passengers wait at shared stops and board any bus that reaches their destination,
+# and buses are pooled per depot, so a bus returning to KR Bus Terminal from an A1 trip can take the next A2 trip.
+# As in sim_engine, trip timing does not depend on passengers: the event order is planned once, then replayed with
+# passenger counts for many replicas at a time.
+
+import heapq
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from bus_simulation import DAY_END
+from event_log import DEPART, RETURN, STOP, EventLog
+from route_demand import NetworkDemand
+from route_network import BUS_CAPACITY, bus_freq, bus_routes
+from sim_engine import NORMAL, URGENT
+from timetable import band_departures
+
+
+class NetworkPlan:
+    """Event order of all services over one day, as parallel arrays. Times are minutes of the day."""
+
+    __slots__ = ('kind', 'time', 'service', 'trip', 'stop', 'trip_service', 'trip_bus')
+
+    def __init__(self, kind, time, service, trip, stop, trip_service, trip_bus):
+        self.kind = kind # DEPART, STOP or RETURN
+        self.time = time
+        self.service = service # index of the service of the event
+        self.trip = trip # index into the trips of all services
+        self.stop = stop # position on the route for STOP events, -1 otherwise
+        self.trip_service = trip_service
+        self.trip_bus = trip_bus # bus that ran each trip, numbered across depots, 0 if no bus was available
+
+    def missed_trips(self, n_services):
+        # Missed departures per service
+        departed = self.trip[self.kind == DEPART]
+        missed = departed[self.trip_bus[departed] == 0]
+        return np.bincount(self.trip_service[missed], minlength=n_services)
+
+
+def build_network_plan(departures, legs, service_depot, fleets, end_time):
+    """
+    Plans the trips of every service with the scheduling rules of build_plan. departures and legs hold one array per
+    service, service_depot the depot index of each service and fleets the number of buses of each depot.
+    """
+    heap = []
+    eid = itertools.count()
+    trip_offset = np.concatenate([[0], np.cumsum([len(d) for d in departures])]).astype(np.int64)
+    trip_service = np.repeat(np.arange(len(departures)), np.diff(trip_offset)).astype(np.int32)
+    trip_bus = np.zeros(trip_offset[-1], dtype=np.int32)
+    first_bus = np.concatenate([[1], 1 + np.cumsum(fleets)])
+    queue_buses = [list(range(first_bus[d], first_bus[d + 1])) for d in range(len(fleets))]
+    kinds, times, services, trips, stops = [], [], [], [], []
+
+    for k, service_departures in enumerate(departures):
+        if len(service_departures):
+            heapq.heappush(heap, (service_departures[0], NORMAL, next(eid), DEPART, k, 0, -1))
+    while heap:
+        now, _, _, kind, k, trip, stop = heapq.heappop(heap)
+        if now >= end_time:
+            break
+        kinds.append(kind), times.append(now), services.append(k), trips.append(trip_offset[k] + trip), stops.append(stop)
+        queue = queue_buses[service_depot[k]]
+
+        if kind == DEPART:
+            if queue:
+                trip_bus[trip_offset[k] + trip] = queue.pop(0)
+                heapq.heappush(heap, (now, URGENT, next(eid), STOP, k, trip, 0))
+            if trip + 1 < len(departures[k]):
+                heapq.heappush(heap, (departures[k][trip + 1], NORMAL, next(eid), DEPART, k, trip + 1, -1))
+        elif kind == STOP:
+            if stop < len(legs[k]):
+                heapq.heappush(heap, (now + legs[k][stop], NORMAL, next(eid), STOP, k, trip, stop + 1))
+            else: # return to the depot
+                heapq.heappush(heap, (now, NORMAL, next(eid), RETURN, k, trip, -1))
+        else:
+            queue.append(int(trip_bus[trip_offset[k] + trip]))
+
+    return NetworkPlan(np.array(kinds, dtype=np.int8), np.array(times, dtype=float), np.array(services, dtype=np.int32),
+                       np.array(trips, dtype=np.int64), np.array(stops, dtype=np.int32), trip_service, trip_bus)
+
+
+def fill_bus(want, wanted, room):
+    # Splits the room on a full bus between destinations in proportion to the passengers waiting for each, giving the
+    # seats left after rounding down to the largest remainders
+    share = want * (np.minimum(room, wanted) / np.maximum(wanted, 1))
+    taken = np.floor(share).astype(np.int64)
+    remainder = share - taken
+    rank = np.argsort(np.argsort(-remainder, axis=0, kind='stable'), axis=0, kind='stable')
+    leftover = np.minimum(room, wanted) - taken.sum(axis=0)
+
+    return taken + (rank < leftover)
+
+
+def network_loads(plan, route_stops, demand, bus_capacity, n, rng, record=False):
+    """
+    Replays the stop events of a NetworkPlan for n replicas at once. Queues are kept per (stop, destination) and
+    shared by all services; a bus takes the passengers whose destination is further along its route, sharing its
+    room between destinations when it fills up. route_stops holds the network stop index of every route position.
+    """
+    n_stops = len(demand.stops)
+    stop_events = np.flatnonzero(plan.kind == STOP)
+    services, positions = plan.service[stop_events], plan.stop[stop_events]
+    stop_codes = np.array([route_stops[k][p] for k, p in zip(services.tolist(), positions.tolist())], dtype=np.int64)
+    buses = plan.trip_bus[plan.trip[stop_events]]
+    last = np.array([len(route) - 1 for route in route_stops])[services] == positions
+
+    # Expected arrivals at the stop of every event since the previous visit of any bus to that stop
+    expected = demand.arrivals[stop_codes, demand.minute_index(plan.time[stop_events])]
+    order = np.argsort(stop_codes, kind='stable')
+    previous = np.zeros(len(order))
+    same_stop = stop_codes[order][1:] == stop_codes[order][:-1]
+    previous[order[1:]] = np.where(same_stop, expected[order][:-1], 0)
+    new_arrivals = np.maximum(expected - previous, 0)
+
+    # Destinations that passengers go to from each stop, and those a bus can take them to from each route position
+    dest_idx = [np.flatnonzero(row) for row in demand.destinations]
+    dest_probs = [demand.destinations[s, idx][:, None] for s, idx in enumerate(dest_idx)]
+    eligible = [[np.unique([s for s in route[p+1:] if s != route[p]]).astype(np.int64) for p in range(len(route))]
+                for route in route_stops]
+
+    queue = np.zeros((n_stops, n_stops, n), dtype=np.int64) # (stop, destination, replica)
+    onboard = np.zeros((plan.trip_bus.max(initial=0) + 1, n_stops, n), dtype=np.int64) # by bus and destination
+    load = np.zeros((len(onboard), n), dtype=np.int64)
+    served, peak, left_behind = (np.zeros(n, dtype=np.int64) for _ in range(3))
+    if record:
+        alight_log, board_log, onboard_log = (np.zeros((len(stop_events), n), dtype=np.int64) for _ in range(3))
+
+    for event, (k, p, s, bus, lam, is_last) in enumerate(zip(services.tolist(), positions.tolist(), stop_codes.tolist(),
+                                                              buses.tolist(), new_arrivals.tolist(), last.tolist())):
+        if lam > 0 and len(dest_idx[s]):
+            queue[s, dest_idx[s]] += rng.poisson(lam * dest_probs[s], size=(len(dest_idx[s]), n))
+        bus_load = onboard[bus]
+        if is_last: # everyone alights at the end of the route
+            alighting = load[bus].copy()
+            bus_load[:] = 0
+            boarding = np.zeros(n, dtype=np.int64)
+        else:
+            alighting = bus_load[s].copy()
+            bus_load[s] = 0
+            room = bus_capacity - (load[bus] - alighting)
+            dests = eligible[k][p]
+            want = queue[s, dests]
+            wanted = want.sum(axis=0)
+            full = wanted > room
+            if full.any():
+                taken = np.where(full, fill_bus(want, wanted, room), want)
+            else:
+                taken = want
+            queue[s, dests] -= taken
+            bus_load[dests] += taken
+            boarding = taken.sum(axis=0)
+            served += boarding
+            left_behind += np.where(boarding == room, wanted - boarding, 0)
+        load[bus] += boarding - alighting
+        peak = np.maximum(peak, load[bus])
+        if record:
+            alight_log[event], board_log[event], onboard_log[event] = alighting, boarding, load[bus]
+
+    loads = {'passengers_served': served, 'peak_load': peak, 'left_behind': left_behind,
+             'waiting_at_end': queue.sum(axis=(0, 1))}
+    if record:
+        loads.update(alight=alight_log, board=board_log, onboard=onboard_log)
+
+    return loads
+
+
+class NetworkSimulation:
+    """
+    Simulates every service in routes together on one day of predicted demand. fleets gives the number of buses of
+    each depot; by default each service runs from the depot at the start of its route, so A1 and A2 share the buses
+    of KR Bus Terminal and D1 and D2 those of COM3. Pass depots (service -> depot) to pool them differently.
+    """
+
+    def __init__(self, ctx, fleets, day='Monday', depots=None, bus_capacity=BUS_CAPACITY, routes=bus_routes, freq_dict=bus_freq):
+        self.services = list(routes)
+        self.depot_of = depots if depots is not None else {bus: route[0] for bus, route in routes.items()}
+        self.depots = list(dict.fromkeys(self.depot_of[bus] for bus in self.services))
+        self.fleets = fleets
+        self.bus_capacity = bus_capacity
+        self.demand = NetworkDemand.from_context(ctx, day, routes)
+
+        stop_index = {stop: i for i, stop in enumerate(self.demand.stops)}
+        self.stop_names = {bus: list(routes[bus]) for bus in self.services}
+        self.route_stops = [np.array([stop_index[stop] for stop in routes[bus]]) for bus in self.services]
+        departures = [band_departures(freq_dict[bus]).astype(float) for bus in self.services]
+        legs = [ctx.route_data(bus)['duration_to_next'].to_numpy(dtype=float)[:-1] for bus in self.services]
+        self.plan = build_network_plan(departures, legs, [self.depots.index(self.depot_of[bus]) for bus in self.services],
+                                       [fleets[depot] for depot in self.depots], DAY_END)
+        self.events = None # EventLog of each service from the last run
+
+    def missed_trips(self):
+        return dict(zip(self.services, self.plan.missed_trips(len(self.services)).tolist()))
+
+    def run(self, seed=None):
+        """Simulates one day and returns an EventLog per service, with times as minutes of the day."""
+        plan = self.plan
+        loads = network_loads(plan, self.route_stops, self.demand, self.bus_capacity, 1, np.random.default_rng(seed), record=True)
+        stops = plan.kind == STOP
+        columns = {name: np.zeros(len(plan.kind), dtype=np.int32) for name in ('board', 'alight', 'onboard')}
+        for name in columns:
+            columns[name][stops] = loads[name][:, 0]
+
+        self.events = {}
+        for k, bus in enumerate(self.services):
+            rows = plan.service == k
+            self.events[bus] = EventLog.from_columns(self.stop_names[bus], 0, time=plan.time[rows],
+                                                     bus_id=plan.trip_bus[plan.trip[rows]], stop_idx=plan.stop[rows],
+                                                     event_type=plan.kind[rows], **{name: column[rows] for name, column in columns.items()})
+
+        return self.events
+
+    def run_replicas(self, n, seed=None):
+        # Passengers served, peak load, passengers left behind and still waiting at the end of the day, per replica
+        return network_loads(self.plan, self.route_stops, self.demand, self.bus_capacity, n, np.random.default_rng(seed))
+
+    def summary(self):
+        # Trips, missed trips and passengers per service from the last run
+        return pd.DataFrame([{'ISB_Service': bus, 'trips': int((self.plan.trip_service == k).sum()),
+                              'missed_trips': self.events[bus].missed_trips(),
+                              'passengers_served': self.events[bus].passengers_served(),
+                              'peak_load': self.events[bus].peak_load()} for k, bus in enumerate(self.services)])
@@ -0,0 +1,216 @@
+# ROUTE OPTIMIZATION
+# Functions behind the "Optimal Route and Bus Allocation" section of the app. They take an AppContext for the
+# datasets and route data, so they can also be used from scripts without the Streamlit UI.
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from density import EXCLUDED_SERVICES, assign_scores, density_scores, density_tensor
+from route_network import BUS_CAPACITY, bus_routes, network
+from timetable import minute_of_day
+
+# algorithm for route optimization is the calculation of satisfaction score
+
+def buses_at_bus_stops(bus_stops):
+    # Services calling at each stop, in the order of bus_routes
+    return {stop: list(network.services_at.get(stop, [])) for stop in bus_stops['Bus Stop']}
+
+def generate_schedule(ctx, bus_stop, bus):
+    # Minutes of the day at which the bus leaves the stop
+    return ctx.timetable.stop_departures(bus_stop, bus)
+
+def get_next_bus_time(ctx, curr_minute, bus_stop, bus):
+    next_bus, _ = ctx.departure_index.next_departure(bus_stop, bus, [minute_of_day(curr_minute)])
+    return int(next_bus[0]) if not np.isnan(next_bus[0]) else None
+
+def time_diff(time1, time2):
+    return minute_of_day(time2) - minute_of_day(time1)
+
+def demand_for_day(ctx, day):
+    demand = ctx.predicted_demand
+    return demand[demand['day_of_the_week'] == day]
+
+def get_density_scores(ctx, bus_stop, day, start_minute, end_minute):
+    # Minute-by-minute waiting counts and scores of one stop, as a DataFrame indexed by minute of the day
+    i = ctx.stops.index(bus_stop)
+    window, waiting, totals = density_tensor(ctx.demand_counts(day)[i:i+1], ctx.departure_mask[i:i+1], ctx.served_matrix[i:i+1],
+                                             ctx.services, start_minute, end_minute)
+    buses = [bus for j, bus in enumerate(ctx.services) if ctx.served_matrix[i, j] and bus not in EXCLUDED_SERVICES]
+    density_df = pd.DataFrame({bus: waiting[0, ctx.services.index(bus)] for bus in buses},
+                              index=pd.Index(window, name='minute_of_day'))
+    density_df['Total'] = totals[0]
+    density_df['Score'] = assign_scores(totals[0])
+
+    return density_df
+
+
+def get_satisfaction_scores(ctx, day, start_minute, end_minute):
+    # Create dictionary to store number of people waiting and the scores
+    waittime_dict = {
+        stop_name: {bus: 0 for bus in bus_routes.keys()} for stop_name in ctx.bus_stops['Bus Stop'] # metric score
+    }
+    demand_by_day = demand_for_day(ctx, day)
+    demand_by_day_time = demand_by_day[demand_by_day['minute_of_day'].between(start_minute, end_minute)]
+    bus_stops_buses = buses_at_bus_stops(ctx.bus_stops)
+
+    # Minutes to the next bus for every demand row in one lookup
+    _, minutes_to_next_bus = ctx.departure_index.lookup(demand_by_day_time['bus_stop_board'], demand_by_day_time['ISB_Service'],
+                                                        demand_by_day_time['minute_of_day'].to_numpy())
+    waiting = pd.Series(demand_by_day_time['predicted_count'].to_numpy() * minutes_to_next_bus)
+    total_waiting_times = waiting.groupby([demand_by_day_time['bus_stop_board'].to_numpy(), demand_by_day_time['ISB_Service'].to_numpy()]).sum()
+
+    for stop in bus_stops_buses.keys():
+        for bus in bus_stops_buses[stop]:
+            waittime_dict[stop][bus] = total_waiting_times.get((stop, bus), 0.0)
+
+    return waittime_dict
+
+def get_priority_score(ctx, score_dict, day, start_minute, end_minute):
+    stop_density_scores = density_scores(ctx, day, start_minute, end_minute) # all stops at once
+    priority_dict = {}
+    for stop in score_dict.keys():
+        priority_dict[stop] = score_dict[stop]['A1'] + score_dict[stop]['A2'] + score_dict[stop]['D1'] + score_dict[stop]['D2']
+        priority_dict[stop] += stop_density_scores[stop]
+
+    priority_dict = dict(sorted(priority_dict.items(), key=lambda item: item[1], reverse=True))
+
+    return priority_dict
+
+def generate_time_intervals(start_minute, end_minute):
+    # Minutes of the day at which the 15-minute intervals of the window start
+    return list(range(start_minute, end_minute, 15))
+
+def get_demand(data):
+    demand_by_interval = data.groupby(['ISB_Service', 'day_of_the_week', 'hour', 'minute'], observed=True)['predicted_count'].sum().reset_index(name='predicted_count')
+    return demand_by_interval
+
+
+def fleet_requirement(peak_demand, turnaround_times, bus_capacity=BUS_CAPACITY):
+    """
+    Buses needed for a (service x interval) matrix of peak demand per 15-minute interval, NaN where a service has no
+    demand, and the turnaround time of each service (0 or NaN if unknown). Leading axes are separate scenarios.
+    Returns (per_interval, per_route): the buses needed by all services in each interval, and the most buses each
+    service needs in any interval (NaN for services without demand or turnaround time).
+    """
+    turnaround = np.asarray(turnaround_times, dtype=float)
+    turnaround = np.where(turnaround > 0, turnaround, np.nan)[..., None]
+    trips_per_interval = 15 / turnaround
+    needed = np.ceil(np.ceil(np.asarray(peak_demand, dtype=float) / bus_capacity) / trips_per_interval)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-NaN rows
+        per_route = np.nanmax(needed, axis=-1)
+
+    return np.nansum(needed, axis=-2), per_route
+
+
+def peak_demand_matrix(data):
+    # Largest predicted_count of any stop per (service, hour, minute), as a (service x interval) matrix
+    peaks = data.groupby(['ISB_Service', 'hour', 'minute'], observed=True)['predicted_count'].max().unstack(['hour', 'minute'])
+    return peaks.sort_index(axis=1)
+
+
+## Function to calculate optimal bus allocation
+def optimize_buses_needed(data, route_times, bus_capacity):
+    peaks = peak_demand_matrix(data)
+    turnaround = [route_times.get(bus) or 0 for bus in peaks.index]
+    per_interval, per_route = fleet_requirement(peaks.to_numpy(dtype=float), turnaround, bus_capacity)
+
+    buses_per_interval = peaks.columns.to_frame(index=False)
+    buses_per_interval['min_buses_needed'] = per_interval
+    buses_needed_per_route = pd.DataFrame({'ISB_Service': peaks.index, 'buses_needed': per_route})
+
+    return buses_per_interval, buses_needed_per_route
+
+def express_scenarios(ctx, data, express, day, time):
+    """
+    Pre-aggregates the demand of a day for the express what-if once. Returns a function that gives the buses needed per
+    route (services x ratios) for an array of ratios, where each ratio of the demand at the express stops during the
+    intervals in time (their first minutes of the day) moves from the existing services to the express bus 'EX'.
+    """
+    temp = data[data['day_of_the_week'] == day]
+    keys = (temp['hour'] * 60 + temp['minute']).to_numpy()
+    window = np.array(time, dtype=keys.dtype)
+    slots = np.union1d(keys, window)
+    services = sorted(temp['ISB_Service'].unique())
+    service_codes = pd.Categorical(temp['ISB_Service'], categories=services).codes
+    slot_codes = np.searchsorted(slots, keys)
+    at_express = temp['bus_stop_board'].isin(express).to_numpy()
+    in_window = np.isin(slots, window)
+
+    # Peak demand per (service, interval) over the express stops and over the other stops, NaN where there are no rows
+    def peak(rows):
+        grouped = pd.Series(temp['predicted_count'].to_numpy(dtype=float)[rows]).groupby(
+            [service_codes[rows], slot_codes[rows]]).max()
+        peaks = np.full((len(services), len(slots)), np.nan)
+        peaks[grouped.index.get_level_values(0), grouped.index.get_level_values(1)] = grouped.to_numpy()
+        return peaks
+    peak_other, peak_express = peak(~at_express), peak(at_express)
+
+    # Largest total demand of an express stop in each interval of the window, the demand that the express bus takes
+    stop_totals = pd.Series(temp['predicted_count'].to_numpy(dtype=float)[at_express]).groupby(
+        [temp['bus_stop_board'].to_numpy()[at_express], slot_codes[at_express]]).sum()
+    express_peak = np.zeros(len(slots))
+    if len(stop_totals):
+        by_slot = stop_totals.groupby(level=1).max()
+        express_peak[by_slot.index] = by_slot.to_numpy()
+    express_peak = np.where(in_window, express_peak, np.nan)
+
+    route_times = [ctx.route_times.get(bus, 0) or 0 for bus in services] + [ctx.route_timing(express)]
+    turnaround = np.array(route_times, dtype=float)
+
+    def buses_per_route(ratios):
+        ratios = np.asarray(ratios, dtype=float)[:, None, None]
+        scaled = np.where(in_window, (1 - ratios) * peak_express, peak_express)
+        peaks = np.fmax(peak_other, scaled)
+        peaks = np.concatenate([peaks, ratios * express_peak], axis=1)
+        return fleet_requirement(peaks, turnaround)[1]
+
+    # Ratios at which the buses needed by a service or by the express bus change. The demand of a service at the
+    # express stops needs k busloads or fewer from ratio 1 - k * capacity / demand up, and the express bus needs k
+    # busloads or fewer up to ratio k * capacity / demand, so the total is constant between these ratios
+    scaled_peaks = peak_express[:, in_window]
+    scaled_peaks = scaled_peaks[scaled_peaks > 0]
+    express_peaks = express_peak[express_peak > 0]
+    breakpoints = [1 - np.arange(np.ceil(peak / BUS_CAPACITY)) * BUS_CAPACITY / peak for peak in scaled_peaks]
+    breakpoints += [np.arange(np.ceil(peak / BUS_CAPACITY) + 1) * BUS_CAPACITY / peak for peak in express_peaks]
+
+    buses_per_route.services = services + ['EX']
+    buses_per_route.breakpoints = np.unique(np.concatenate(breakpoints + [[0.0, 1.0]]))
+    return buses_per_route
+
+
+def consider_express(ctx, data, express, day, time, initial_ratio=0.2, increment=0.1, search='grid'):
+    """
+    Finds the ratio of demand at the express stops that should take the express bus to need the fewest buses.
+    search='grid' tries ratios from initial_ratio to 1 in steps of increment; search='exact' also tries every ratio
+    between initial_ratio and 1 at which the number of buses changes, which finds the smallest total over all ratios.
+    Returns the buses needed per route, the ratio and the total.
+    """
+    buses_per_route = express_scenarios(ctx, data, express, day, time)
+
+    ratios = []
+    ratio = initial_ratio
+    while ratio <= 1.0:
+        ratios.append(ratio)
+        ratio += increment
+    totals = np.nansum(buses_per_route(ratios), axis=1)
+    best = int(np.argmin(totals)) # the first of equally good ratios
+    optimal_ratio, min_total_buses = ratios[best], totals[best]
+
+    if search == 'exact':
+        # The total is a step function of the ratio whose smallest values are taken at its breakpoints. Each
+        # breakpoint is also tried one rounding step to either side, in case it lands on the wrong side of a step
+        candidates = buses_per_route.breakpoints
+        candidates = np.concatenate([candidates, np.nextafter(candidates, 0), np.nextafter(candidates, 1)])
+        candidates = np.unique(candidates[(candidates >= initial_ratio) & (candidates <= 1)])
+        totals = np.nansum(buses_per_route(candidates), axis=1)
+        best = int(np.argmin(totals)) # the smallest of equally good ratios
+        if totals[best] < min_total_buses:
+            optimal_ratio, min_total_buses = float(candidates[best]), totals[best]
+
+    optimal_buses_needed = pd.DataFrame({'ISB_Service': buses_per_route.services,
+                                         'buses_needed': buses_per_route([optimal_ratio])[0]})
+    optimal_buses_needed = optimal_buses_needed.sort_values('ISB_Service').reset_index(drop=True)
+    return optimal_buses_needed, optimal_ratio, min_total_buses
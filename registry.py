@@ -0,0 +1,83 @@
+# STOP, SERVICE AND DAY CODES
+# Canonical names of the stops, services and days with stable integer codes. Labels from the survey, the synthetic
+# data and the forecast are normalised first ('BTC (Bukit Timah Campus)' is service BTC, the misspelt 'Botanic
+# Gardents MRT (BTC)' is 'Botanic Gardens MRT (BTC)' and 'University Health Centre' is UHC), then kept as pandas
+# Categoricals with the canonical names as their first categories. Frames from different files therefore share codes,
+# and filters and joins compare small integers. Values outside the registry, such as 'No trip', keep categories of
+# their own after the canonical ones.
+
+import numpy as np
+import pandas as pd
+
+from route_network import ROUTES, SURVEY_LABELS
+
+SERVICE_ALIASES = {label: bus for bus, label in SURVEY_LABELS.items()}
+STOP_ALIASES = {'Botanic Gardents MRT (BTC)': 'Botanic Gardens MRT (BTC)', 'University Health Centre': 'UHC'}
+
+SERVICES = list(ROUTES)
+STOPS = list(dict.fromkeys(stop for route in ROUTES.values() for stop in route))
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+KINDS = {'service': (SERVICES, SERVICE_ALIASES), 'stop': (STOPS, STOP_ALIASES), 'day': (DAYS, {})}
+COLUMN_KINDS = {'ISB_Service': 'service', 'bus_stop_board': 'stop', 'bus_stop_alight': 'stop', 'day_of_the_week': 'day'}
+
+SERVICE_DTYPE = pd.CategoricalDtype(SERVICES)
+STOP_DTYPE = pd.CategoricalDtype(STOPS)
+DAY_DTYPE = pd.CategoricalDtype(DAYS)
+
+
+def column_kind(column):
+    # 'service', 'stop' or 'day' for columns such as ISB_Service or bus_stop_board_trip_2, None for other columns
+    for prefix, kind in COLUMN_KINDS.items():
+        if column == prefix or column.startswith(prefix + '_'):
+            return kind
+    return None
+
+
+def normalize(value, kind):
+    return KINDS[kind][1].get(value, value)
+
+
+def categorical(values, kind):
+    """
+    Normalised Categorical of service, stop or day labels. The registry names come first, so their codes are the same
+    in every frame; other values are appended in sorted order and missing values stay missing.
+    """
+    names, aliases = KINDS[kind]
+    raw = pd.Categorical(values) # each distinct label is normalised once
+    mapped = [aliases.get(label, label) for label in raw.categories]
+    known = set(names)
+    categories = names + sorted({label for label in mapped if label not in known}, key=str)
+    index = {label: i for i, label in enumerate(categories)}
+    lookup = np.array([index[label] for label in mapped] + [-1], dtype=np.int32) # code -1 (missing) maps to -1
+
+    return pd.Categorical.from_codes(lookup[raw.codes], dtype=pd.CategoricalDtype(categories))
+
+
+def codes(values, kind):
+    # Registry code of every value, -1 for missing values and values outside the registry
+    cat = categorical(values, kind)
+    return np.where(cat.codes < len(KINDS[kind][0]), cat.codes, -1).astype(np.int16)
+
+
+def positions(values, names, kind):
+    """
+    Position of every value in the list names, -1 where it is missing. Values are matched through their codes, so a
+    column of half a million stops costs one lookup per distinct stop.
+    """
+    cat = categorical(values, kind)
+    index = {normalize(name, kind): i for i, name in enumerate(names)}
+    lookup = np.array([index.get(label, -1) for label in cat.categories] + [-1], dtype=np.int64)
+
+    return lookup[cat.codes]
+
+
+def encode(data):
+    # Copy of a frame with every service, stop and day column as a normalised Categorical
+    data = data.copy()
+    for column in data.columns:
+        kind = column_kind(column)
+        if kind is not None:
+            data[column] = pd.Series(categorical(data[column], kind), index=data.index)
+
+    return data
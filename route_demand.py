@@ -0,0 +1,156 @@
+# ROUTE DEMAND
+# Passenger arrivals and destinations along one bus service, taken from the demand forecast and the survey trips.
+# Everything is turned into arrays indexed by position on the route, so the simulator never filters a DataFrame.
+
+import numpy as np
+
+from density import MINUTES_PER_DAY
+from route_network import bus_freq, bus_routes
+from timetable import band_departures
+
+
+def forecast_interval(demand):
+    # Minutes between the time slots of the forecast, e.g. 15 for quarter-hourly predictions
+    minutes = np.unique(demand['minute_of_day'])
+    steps = np.diff(minutes)
+    steps = steps[steps > 0]
+
+    return int(steps.min()) if len(steps) else 1
+
+
+def spread_counts(counts, interval):
+    # Spreads the count of each forecast slot evenly over the minutes of the slot
+    if interval <= 1:
+        return counts
+    cum = np.concatenate([np.zeros(counts.shape[:-1] + (1,)), np.cumsum(counts, axis=-1)], axis=-1)
+    lagged = np.concatenate([np.zeros(counts.shape[:-1] + (interval,)), cum[..., :-interval]], axis=-1)
+
+    return (cum - lagged)[..., 1:] / interval
+
+
+def destination_matrix(route, flows):
+    """
+    Probability of alighting at each later position of the route for passengers boarding at each position, from
+    (bus_stop_board, bus_stop_alight, count) flows. A passenger alights at the first visit to their stop after boarding.
+    Positions without any recorded trips send passengers to all later stops with equal probability.
+    """
+    n = len(route)
+    counts = np.zeros((n, n))
+    first_visit = {}
+    for i, stop in enumerate(route[:-1]):
+        first_visit.setdefault(stop, i)
+    for board, alight, count in flows:
+        i = first_visit.get(board)
+        if i is None:
+            continue
+        later = [j for j in range(i + 1, n) if route[j] == alight]
+        if later:
+            counts[i, later[0]] += count
+
+    for i in range(n - 1):
+        if counts[i].sum() == 0:
+            counts[i, i+1:] = 1
+    totals = counts.sum(axis=1, keepdims=True)
+
+    return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+
+class RouteDemand:
+    """
+    Demand seen by the buses of one service on one day.
+
+    arrivals[p, m] is the expected number of passengers that have come to position p of the route before minute m of
+    the day, so the arrivals between two buses are a difference of two entries. destinations[p] are the alighting
+    probabilities of passengers boarding at position p. start_minute is the minute of the day of the first departure,
+    which is time 0 of the simulation.
+    """
+
+    def __init__(self, arrivals, destinations, start_minute):
+        self.arrivals = arrivals
+        self.destinations = destinations
+        self.start_minute = start_minute
+
+    @classmethod
+    def from_context(cls, ctx, bus, day, freq_dict=bus_freq):
+        # Arrival rates from the predicted demand of the day, destinations from the survey trips of the service
+        route = bus_routes[bus]
+        start_minute = int(band_departures(freq_dict[bus])[0])
+        counts = spread_counts(ctx.demand_counts(day)[:, ctx.services.index(bus)], ctx.demand_interval)
+        rates = np.zeros((len(route), MINUTES_PER_DAY))
+        seen = set()
+        for p, stop in enumerate(route[:-1]): # nobody boards at the last stop
+            if stop in ctx.stops and stop not in seen:
+                rates[p] = counts[ctx.stops.index(stop)]
+            seen.add(stop)
+        arrivals = np.concatenate([np.zeros((len(route), 1)), np.cumsum(rates, axis=1)], axis=1)
+
+        flows = ctx.trip_flows
+        flows = flows[flows['ISB_Service'] == bus]
+        destinations = destination_matrix(route, zip(flows['bus_stop_board'], flows['bus_stop_alight'], flows['count']))
+
+        return cls(arrivals, destinations, start_minute)
+
+    def minute_index(self, minutes):
+        # Column of arrivals holding everyone that has come by a simulation time
+        return np.clip(np.floor(self.start_minute + np.asarray(minutes)).astype(np.int64) + 1, 0, MINUTES_PER_DAY)
+
+
+def network_stops(routes):
+    # Every stop of the network once, in the order in which the routes first reach them
+    return list(dict.fromkeys(stop for route in routes.values() for stop in route))
+
+
+def reachable_matrix(stops, routes):
+    # True where some service goes from a stop to another stop without passing its terminal
+    index = {stop: i for i, stop in enumerate(stops)}
+    reachable = np.zeros((len(stops), len(stops)), dtype=bool)
+    for route in routes.values():
+        codes = [index[stop] for stop in route]
+        for p in range(len(codes) - 1):
+            reachable[codes[p], codes[p+1:]] = True
+    np.fill_diagonal(reachable, False)
+
+    return reachable
+
+
+class NetworkDemand:
+    """
+    Demand at every stop of the network on one day, for passengers that can take any service to their destination.
+
+    arrivals[s, m] is the expected number of passengers that have come to stop s before minute m of the day, over all
+    services. destinations[s] are the probabilities of travelling from stop s to each stop that a service reaches
+    from it, from the survey trips of all services.
+    """
+
+    def __init__(self, stops, arrivals, destinations):
+        self.stops = stops
+        self.arrivals = arrivals
+        self.destinations = destinations
+
+    @classmethod
+    def from_context(cls, ctx, day, routes=bus_routes):
+        stops = network_stops(routes)
+        counts = spread_counts(ctx.demand_counts(day), ctx.demand_interval).sum(axis=1) # all services of a stop
+        rates = np.zeros((len(stops), MINUTES_PER_DAY))
+        for s, stop in enumerate(stops):
+            if stop in ctx.stops:
+                rates[s] = counts[ctx.stops.index(stop)]
+        arrivals = np.concatenate([np.zeros((len(stops), 1)), np.cumsum(rates, axis=1)], axis=1)
+
+        reachable = reachable_matrix(stops, routes)
+        index = {stop: i for i, stop in enumerate(stops)}
+        flows = ctx.trip_flows.groupby(['bus_stop_board', 'bus_stop_alight'], observed=True)['count'].sum()
+        trips = np.zeros((len(stops), len(stops)))
+        for (board, alight), count in flows.items():
+            if board in index and alight in index:
+                trips[index[board], index[alight]] += count
+        trips = np.where(reachable, trips, 0)
+        trips = np.where(trips.sum(axis=1, keepdims=True) > 0, trips, reachable) # no surveyed trips from the stop
+        totals = trips.sum(axis=1, keepdims=True)
+        destinations = np.divide(trips, totals, out=np.zeros_like(trips), where=totals > 0)
+
+        return cls(stops, arrivals, destinations)
+
+    def minute_index(self, minutes):
+        # Column of arrivals holding everyone that has come by a minute of the day
+        return np.clip(np.floor(np.asarray(minutes)).astype(np.int64) + 1, 0, MINUTES_PER_DAY)
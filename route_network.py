@@ -0,0 +1,170 @@
+# Stop sequences and timetables of the NUS internal shuttle bus services.
+# The stop sequences are kept in bus_routes.json, the one copy that the app, the cleaners, the synthesizer constraints
+# and the notebooks all read. RouteNetwork precomputes the lookups they need, so no caller searches a route list.
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+ROUTES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bus_routes.json')
+SURVEY_LABELS = {'BTC': 'BTC (Bukit Timah Campus)'} # service names as the survey form spells them, where they differ
+
+
+def load_routes(path=ROUTES_PATH):
+    # Service -> list of stops, in the order of the file
+    with open(path) as f:
+        return json.load(f)
+
+
+def first_positions(route):
+    # Position of the first visit to every stop of a route
+    positions = {}
+    for i, stop in enumerate(route):
+        positions.setdefault(stop, i)
+    return positions
+
+
+def valid_pairs(route):
+    """
+    (board, alight) pairs that a passenger can ride on a route: alighting after boarding, at another stop. On a
+    route that ends where it starts, alighting at the first stop means riding to the end of the loop.
+    """
+    positions = first_positions(route)
+    pairs = set()
+    for board, start in positions.items():
+        for alight, end in positions.items():
+            if alight == route[0]:
+                end = len(route)
+            if start < end and board != alight:
+                pairs.add((board, alight))
+
+    return frozenset(pairs)
+
+
+def label_codes(values, index):
+    # Index of every label in a label -> index map, -1 for missing and unknown labels; each distinct label is looked up once
+    cat = pd.Categorical(values)
+    lookup = np.array([index.get(label, -1) for label in cat.categories] + [-1], dtype=np.int64)
+    return lookup[cat.codes]
+
+
+class RouteNetwork:
+    """
+    Routes of a set of services with their lookups: the stops in the order the routes first reach them, a
+    stop -> index map, the position of every stop on every route, the services calling at each stop and the valid
+    (board, alight) pairs of each service.
+    The pairs are also kept as a boolean (service x board x alight) table, so whole columns of trips are checked with
+    one gather. It has an extra all-False row and column at the end, where unknown services and stops (code -1) land.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.services = list(routes)
+        self.stops = list(dict.fromkeys(stop for route in routes.values() for stop in route))
+        self.stop_index = {stop: i for i, stop in enumerate(self.stops)}
+        self.positions = {bus: first_positions(route) for bus, route in routes.items()}
+        self.services_at = {stop: [bus for bus in self.services if stop in self.positions[bus]] for stop in self.stops}
+        self.pairs = {bus: valid_pairs(route) for bus, route in routes.items()}
+        self.service_index = {bus: k for k, bus in enumerate(self.services)}
+        self.valid = np.zeros((len(self.services) + 1, len(self.stops) + 1, len(self.stops) + 1), dtype=bool)
+        for bus, pairs in self.pairs.items():
+            for board, alight in pairs:
+                self.valid[self.service_index[bus], self.stop_index[board], self.stop_index[alight]] = True
+        self.first_stop = np.array([self.stop_index[routes[bus][0]] for bus in self.services] + [-1])
+        # Routes as stop codes padded with -1, their lengths and the first position of every stop on every route,
+        # with the same extra row and column for unknown services and stops
+        longest = max((len(route) for route in routes.values()), default=0)
+        self.route_codes = np.full((len(self.services) + 1, longest), -1, dtype=np.int64)
+        self.route_lengths = np.zeros(len(self.services) + 1, dtype=np.int64)
+        self.stop_positions = np.full((len(self.services) + 1, len(self.stops) + 1), -1, dtype=np.int64)
+        for k, bus in enumerate(self.services):
+            self.route_codes[k, :len(routes[bus])] = [self.stop_index[stop] for stop in routes[bus]]
+            self.route_lengths[k] = len(routes[bus])
+            for stop, i in self.positions[bus].items():
+                self.stop_positions[k, self.stop_index[stop]] = i
+
+    def position(self, bus, stop):
+        # Position of the first visit of a service to a stop, -1 if it does not call there
+        return self.positions[bus].get(stop, -1)
+
+    def is_valid_trip(self, bus, board, alight):
+        return bus in self.pairs and (board, alight) in self.pairs[bus]
+
+    def codes(self, services, boards, alights):
+        # Service, board and alight indices of columns of trips, -1 where the label is not in the network
+        return (label_codes(services, self.service_index), label_codes(boards, self.stop_index),
+                label_codes(alights, self.stop_index))
+
+    def valid_trips(self, services, boards, alights):
+        # Boolean array of the trips that can be ridden, for columns of service, board and alight labels
+        return self.valid[self.codes(services, boards, alights)]
+
+    def services_for(self, board, alight):
+        # Services on which a board -> alight trip is valid
+        if board not in self.stop_index or alight not in self.stop_index:
+            return []
+        column = self.valid[:-1, self.stop_index[board], self.stop_index[alight]]
+        return [self.services[k] for k in np.flatnonzero(column)]
+
+
+ROUTES = load_routes() # every service, including L which has no timetable
+survey_routes = {SURVEY_LABELS.get(bus, bus): route for bus, route in ROUTES.items()} # keyed as in the raw survey data
+
+# Bus frequencies, taken from NUS UCI website 
+# (https://uci.nus.edu.sg/oca/mobilityservices/getting-around-nus/)
+bus_freq = {
+    'A1': {0: ['07:15', '08:00', '9min'],
+           1: ['08:00', '10:00', '5min'],
+           2: ['10:00', '11:00', '11min'],
+           3: ['11:00', '14:00', '6min'],
+           4: ['14:00', '17:15', '9min'],
+           5: ['17:15', '19:30', '6min'],
+           6: ['19:30', '23:00', '15min']},
+    'A2': {
+        0: ['07:15', '10:00', '7min'],
+        1: ['10:00', '11:15', '10min'],
+        2: ['11:15', '14:00', '7min'],
+        3: ['14:00', '17:00', '8min'],
+        4: ['17:00', '19:30', '7min'],
+        5: ['19:30', '21:30', '12min'],
+        6: ['21:30', '23:00', '15min']
+    },
+    'D1': {
+        0: ['07:15', '08:00', '11min'],
+        1: ['08:00', '19:30', '7min'],
+        2: ['19:30', '21:30', '12min'],
+        3: ['21:30', '23:00', '15min']
+    },
+    'D2': {
+        0: ['07:15', '10:00', '6min'],
+        1: ['10:00', '11:15', '10min'],
+        2: ['11:15', '14:00', '6min'],
+        3: ['14:00', '17:15', '8min'],
+        4: ['17:15', '19:30', '6min'],
+        5: ['19:30', '21:30', '11min'],
+        6: ['21:30', '23:00', '15min']
+    },
+    'BTC': {
+        0: ['07:30', '10:00', '30min'],
+        1: ['10:00', '11:10', '35min'],
+        2: ['11:10', '14:10', '30min'],
+        3: ['14:10', '17:10', '45min'],
+        4: ['17:10', '19:40', '30min'],
+        5: ['19:40', '21:10', '45min'],
+        6: ['21:10', '21:40', '30min']
+    },
+    'E': {
+        0: ['08:00', '16:00', '15min'],
+    },
+    'K': {
+        0: ['07:00', '23:00', '15min']
+    }
+}
+
+# Services with a timetable, which the app simulates and optimizes
+bus_routes = {bus: ROUTES[bus] for bus in bus_freq}
+network = RouteNetwork(bus_routes)
+
+BUS_CAPACITY = 88
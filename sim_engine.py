@@ -0,0 +1,248 @@
+# FAST SIMULATION ENGINE
+# Same model as bus_simulation.BusSimulation without SimPy or pandas in the loop. The timing of every trip, and so
+# which departures get a bus, does not depend on how many passengers board. The engine therefore works out the order
+# in which SimPy would process the events once, then replays that plan with per-trip passenger counts in NumPy arrays.
+# Passengers are either drawn at random as in BusSimulation, or come from a RouteDemand built from the forecast.
+
+import heapq
+import itertools
+import random
+
+import numpy as np
+
+from bus_simulation import DAY_END
+from event_log import DEPART, RETURN, STOP, EventLog
+from route_network import BUS_CAPACITY
+from timetable import format_minutes, minute_of_day
+
+URGENT, NORMAL = 0, 1 # SimPy event priorities
+MAX_QUEUE = 50 # upper bound of the random number of passengers waiting at a stop
+
+
+class SimPlan:
+    """Event order of one simulated day, as parallel arrays in the order SimPy processes them."""
+
+    __slots__ = ('kind', 'time', 'trip', 'stop', 'trip_departure', 'trip_bus')
+
+    def __init__(self, kind, time, trip, stop, trip_departure, trip_bus):
+        self.kind = kind # DEPART, STOP or RETURN
+        self.time = time # minutes from the first departure
+        self.trip = trip # index into the schedule, for every kind of event
+        self.stop = stop # index of the stop on the route for STOP events, -1 otherwise
+        self.trip_departure = trip_departure # departure minutes of every scheduled trip
+        self.trip_bus = trip_bus # bus that ran each trip, 0 if no bus was available
+
+    @property
+    def missed_trips(self):
+        departed = self.trip[self.kind == DEPART]
+        return int((self.trip_bus[departed] == 0).sum())
+
+
+def build_plan(departures, legs, num_buses, end_time):
+    """
+    Replays the timing of BusSimulation with SimPy's scheduling rules: events are ordered by time, then urgent
+    before normal (a newly started bus process before timeouts), then by creation order. Events at or after end_time
+    are not processed, as with env.run(until=end_time). legs can also be given per trip, as a (trips x legs) array.
+    """
+    heap = []
+    eid = itertools.count()
+    queue_buses = [i+1 for i in range(num_buses)]
+    trip_bus = np.zeros(len(departures), dtype=np.int32)
+    legs = np.asarray(legs, dtype=float)
+    per_trip = legs.ndim == 2
+    n_stops = legs.shape[-1] + 1
+    kinds, times, trips, stops = [], [], [], []
+
+    if len(departures):
+        heapq.heappush(heap, (departures[0], NORMAL, next(eid), DEPART, 0, -1))
+    while heap:
+        now, _, _, kind, trip, stop = heapq.heappop(heap)
+        if now >= end_time:
+            break
+        kinds.append(kind), times.append(now), trips.append(trip), stops.append(stop)
+
+        if kind == DEPART:
+            if queue_buses:
+                trip_bus[trip] = queue_buses.pop(0)
+                heapq.heappush(heap, (now, URGENT, next(eid), STOP, trip, 0))
+            if trip + 1 < len(departures):
+                heapq.heappush(heap, (now + (departures[trip + 1] - departures[trip]), NORMAL, next(eid), DEPART, trip + 1, -1))
+        elif kind == STOP:
+            if stop < n_stops - 1:
+                leg = legs[trip, stop] if per_trip else legs[stop]
+                heapq.heappush(heap, (now + leg, NORMAL, next(eid), STOP, trip, stop + 1))
+            else: # return to the terminal after a timeout of 0
+                heapq.heappush(heap, (now, NORMAL, next(eid), RETURN, trip, -1))
+        else:
+            queue_buses.append(int(trip_bus[trip]))
+
+    return SimPlan(np.array(kinds, dtype=np.int8), np.array(times, dtype=float), np.array(trips, dtype=np.int32),
+                   np.array(stops, dtype=np.int32), np.asarray(departures, dtype=float), trip_bus)
+
+
+class FastBusSimulation:
+    """
+    Drop-in replacement for BusSimulation. run() gives the same events as BusSimulation.run() when both draw from
+    random.Random objects with the same seed; run_replicas() simulates many independent days at once.
+
+    With a RouteDemand, passengers arrive at the stops as forecast, wait there until a bus has room for them and
+    alight at their destination instead of being drawn at random. rng is then a NumPy generator (or a seed).
+    """
+
+    def __init__(self, bus_df, bus_schedule, num_buses, bus_capacity=BUS_CAPACITY, demand=None):
+        self.stop_names = bus_df['Bus Stop'].tolist()
+        self.legs = bus_df['duration_to_next'].to_numpy(dtype=float)[:-1]
+        self.bus_capacity = bus_capacity
+        self.num_buses = num_buses
+        self.start_minute = minute_of_day(bus_schedule.loc[0, 'depart_time'])
+        self.end_time = DAY_END - self.start_minute
+        self.plan = build_plan(bus_schedule['minutes_from_start'].to_numpy(dtype=float), self.legs, num_buses, self.end_time)
+        self.demand = demand
+        self.events = None # EventLog of the last run
+        self.passengers_served = 0
+        self.left_behind = 0 # passengers that a full bus could not take, with a RouteDemand
+        self.has_run = False
+
+    def sim_time_to_actual(self, minutes):
+        return format_minutes(self.start_minute + minutes)
+
+    def unavailable_count(self):
+        return self.events.missed_trips() if self.has_run else 0
+
+    @property
+    def sim_log(self):
+        return self.events.render() if self.events is not None else []
+
+    def _record(self, board, alight, onboard):
+        # Event log of the plan with the passenger counts of its stop events
+        plan = self.plan
+        stops = plan.kind == STOP
+        columns = {name: np.zeros(len(plan.kind), dtype=np.int32) for name in ('board', 'alight', 'onboard')}
+        columns['board'][stops], columns['alight'][stops], columns['onboard'][stops] = board, alight, onboard
+        self.events = EventLog.from_columns(self.stop_names, self.start_minute, time=plan.time,
+                                            bus_id=plan.trip_bus[plan.trip], stop_idx=plan.stop, event_type=plan.kind, **columns)
+        self.passengers_served = self.events.passengers_served()
+        self.has_run = True
+
+        return self.events
+
+    def run(self, rng=random):
+        """
+        Simulates one day, drawing passengers in the same order as BusSimulation or from the RouteDemand, and returns
+        the EventLog.
+        """
+        if self.demand is not None:
+            loads = demand_loads(self.plan, self.demand, self.bus_capacity, 1,
+                                 np.random.default_rng(None if rng is random else rng), record=True)
+            self.left_behind = int(loads['left_behind'][0])
+            return self._record(loads['board'][:, 0], loads['alight'][:, 0], loads['onboard'][:, 0])
+
+        plan = self.plan
+        last_stop = len(self.stop_names) - 1
+        onboard = np.zeros(len(plan.trip_departure), dtype=np.int64)
+        stops = plan.kind == STOP
+        board_col, alight_col, onboard_col = (np.zeros(int(stops.sum()), dtype=np.int32) for _ in range(3))
+
+        for event, (trip, stop) in enumerate(zip(plan.trip[stops].tolist(), plan.stop[stops].tolist())):
+            on = int(onboard[trip])
+            if stop != last_stop:
+                num_alighting = rng.randint(0, on)
+                on -= num_alighting
+                num_boarding = min(rng.randint(0, MAX_QUEUE), self.bus_capacity - on)
+                on += num_boarding
+            else: # let all passengers alight, do not let passengers board
+                num_alighting, num_boarding = on, 0
+                on = 0
+            onboard[trip] = on
+            board_col[event], alight_col[event], onboard_col[event] = num_boarding, num_alighting, on
+
+        return self._record(board_col, alight_col, onboard_col)
+
+    def run_replicas(self, n, seed=None):
+        """
+        Simulates n independent days with a NumPy generator. Returns arrays of length n with the passengers served,
+        the peak load and the number of missed trips, and with a RouteDemand also the passengers left behind by full
+        buses and those still waiting at the end of the day.
+        """
+        if self.demand is not None:
+            return demand_loads(self.plan, self.demand, self.bus_capacity, n, np.random.default_rng(seed))
+        return replica_loads(self.plan, len(self.stop_names), self.bus_capacity, n, np.random.default_rng(seed))
+
+
+def replica_loads(plan, n_stops, bus_capacity, n, rng):
+    # Every trip is advanced one stop at a time, across all trips and replicas together
+    ran = plan.trip_bus > 0
+    # Stops that are reached before the end of the simulation, per trip
+    reached = np.zeros((len(plan.trip_departure), n_stops), dtype=bool)
+    stop_events = plan.kind == STOP
+    reached[plan.trip[stop_events], plan.stop[stop_events]] = True
+    reached = reached[ran]
+
+    onboard = np.zeros((reached.shape[0], n), dtype=np.int64)
+    served = np.zeros(n, dtype=np.int64)
+    peak = np.zeros(n, dtype=np.int64)
+    for stop in range(n_stops - 1):
+        active = reached[:, stop][:, None]
+        alighting = rng.integers(0, onboard + 1)
+        onboard -= np.where(active, alighting, 0)
+        boarding = np.minimum(rng.integers(0, MAX_QUEUE + 1, size=onboard.shape), bus_capacity - onboard)
+        boarding = np.where(active, boarding, 0)
+        onboard += boarding
+        served += boarding.sum(axis=0)
+        peak = np.maximum(peak, onboard.max(axis=0, initial=0))
+
+    return {'passengers_served': served, 'peak_load': peak, 'missed_trips': np.full(n, plan.missed_trips)}
+
+
+def demand_loads(plan, demand, bus_capacity, n, rng, record=False):
+    """
+    Replays the stop events of a plan with passengers from a RouteDemand, for n replicas at once. Queues are kept per
+    stop and carry over from one bus to the next, and passengers ride to a destination drawn when they board.
+    With record=True, also returns the alighting, boarding and onboard counts of every stop event.
+    """
+    stop_events = np.flatnonzero(plan.kind == STOP)
+    positions = plan.stop[stop_events]
+    trips = plan.trip[stop_events]
+    n_stops = demand.destinations.shape[0]
+    last_stop = n_stops - 1
+
+    # Expected arrivals at the stop of every event since the start of the day, looked up in one go
+    expected = demand.arrivals[positions, demand.minute_index(plan.time[stop_events])]
+    last_expected = np.zeros(n_stops)
+
+    queue = np.zeros((n_stops, n), dtype=np.int64)
+    onboard = np.zeros((len(plan.trip_departure), n_stops, n), dtype=np.int64) # by destination
+    served = np.zeros(n, dtype=np.int64)
+    peak = np.zeros(n, dtype=np.int64)
+    left_behind = np.zeros(n, dtype=np.int64)
+    if record:
+        alight_log, board_log, onboard_log = (np.zeros((len(stop_events), n), dtype=np.int64) for _ in range(3))
+
+    for event, (trip, stop) in enumerate(zip(trips.tolist(), positions.tolist())):
+        load = onboard[trip]
+        if stop != last_stop:
+            queue[stop] += rng.poisson(max(expected[event] - last_expected[stop], 0), n)
+            last_expected[stop] = expected[event]
+            alighting = load[stop].copy()
+            load[stop] = 0
+            room = bus_capacity - load.sum(axis=0)
+            boarding = np.minimum(queue[stop], room)
+            queue[stop] -= boarding
+            left_behind += np.where(boarding == room, queue[stop], 0)
+            load += rng.multinomial(boarding, demand.destinations[stop]).T
+            served += boarding
+        else: # let all passengers alight, do not let passengers board
+            alighting = load.sum(axis=0)
+            load[:] = 0
+            boarding = np.zeros(n, dtype=np.int64)
+        total = load.sum(axis=0)
+        peak = np.maximum(peak, total)
+        if record:
+            alight_log[event], board_log[event], onboard_log[event] = alighting, boarding, total
+
+    loads = {'passengers_served': served, 'peak_load': peak, 'missed_trips': np.full(n, plan.missed_trips),
+             'left_behind': left_behind, 'waiting_at_end': queue.sum(axis=0)}
+    if record:
+        loads.update(alight=alight_log, board=board_log, onboard=onboard_log)
+
+    return loads
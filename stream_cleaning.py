@@ -0,0 +1,207 @@
+# STREAMING CLEANING
+# The cleaning pipeline for survey exports too large for one DataFrame. The export is read in chunks of a bounded
+# number of rows, from CSV or Parquet, in two passes. The first pass runs the stateless steps on every chunk and
+# counts what the stateful steps need from the whole export: the answer counts of the rank columns for apply_rank_fix
+# and the pools of answers that missing values are drawn from. The second pass runs every step on every chunk with
+# that state and appends the result to the output, so memory depends on the chunk size and on the number of distinct
+# answers, not on the length of the export.
+# Usage: python stream_cleaning.py <export csv|parquet> <output csv|parquet> [rows per chunk]
+
+import json
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from clean_functions import duplicate_rank_rows, int_to_ordinal, parse_ranks, replacement_ranks
+from cleaning_pipeline import CLEANING_SEED, SURVEY_STEPS, tagged_table
+
+CHUNK_ROWS = 50000
+RESERVOIR_SIZE = 10000 # answers kept for columns whose answers rarely repeat, such as the timestamps
+
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS):
+    """
+    DataFrames of at most chunk_rows rows of a CSV or Parquet file, with every column as object. Types inferred chunk
+    by chunk would differ between chunks (a trip column that is empty in a chunk would be float64 there), while the
+    steps write text such as "No trip" into any column.
+    """
+    if path.endswith('.parquet'):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas().astype(object)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_rows, dtype=object)
+
+
+def run_step(step, data, chunk, **state):
+    # Runs a step on one chunk. Seeded steps get a seed of their own for every chunk, so that chunks do not repeat
+    # each other's draws and a rerun with the same chunk size gives the same output
+    params = dict(step.params, **state)
+    if 'seed' in params:
+        params['seed'] = [params['seed'], chunk]
+    return step.function(data, **params)
+
+
+class RankCounts:
+    """
+    What apply_rank_fix needs from the whole export: the answer counts of every rank column. For the imputation that
+    follows, it also counts the answers kept by rows without repeated ranks and the number of rows of each group whose
+    ranks are replaced, as the replacement is only known once every answer has been counted.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.distribution = {column: Counter() for columns, _ in groups for column in columns}
+        self.kept = {column: Counter() for column in self.distribution}
+        self.replaced = [0] * len(groups)
+
+    def update(self, data):
+        for g, (columns, _) in enumerate(self.groups):
+            parsed = [parse_ranks(data[column]) for column in columns]
+            repeated = duplicate_rank_rows(np.column_stack([numbers for numbers, _ in parsed]))
+            self.replaced[g] += int(repeated.sum())
+            for column, (_, ordinals) in zip(columns, parsed):
+                self.distribution[column].update(data[column].value_counts().to_dict())
+                self.kept[column].update(pd.Series(ordinals[~repeated]).value_counts().to_dict())
+
+    def pools(self):
+        # Answer counts of the rank columns after apply_rank_fix
+        pools = {}
+        for g, (columns, n_ranks) in enumerate(self.groups):
+            replacement = [int_to_ordinal(rank) for rank in replacement_ranks(columns, self.distribution, set(range(1, n_ranks + 1)))]
+            for j, column in enumerate(columns):
+                counts = Counter(self.kept[column])
+                if j < len(replacement) and self.replaced[g]:
+                    counts[replacement[j]] += self.replaced[g]
+                pools[column] = pd.Series(counts, dtype=np.int64)
+
+        return pools
+
+
+class AnswerPools:
+    """
+    Pools that missing answers are drawn from: the counts of the non-null answers other than "No trip" of every
+    column. Columns whose answers rarely repeat in the first chunk (more distinct answers than half its rows, such as
+    the timestamps) keep a uniform reservoir sample of their answers instead, so the pools stay bounded.
+    """
+
+    def __init__(self, columns, reservoir_size=RESERVOIR_SIZE, seed=CLEANING_SEED):
+        self.columns = columns
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+        self.counts = {}
+        self.samples = {}
+        self.seen = {}
+
+    def update(self, data):
+        for column in self.columns:
+            answers = data[column][data[column] != "No trip"].dropna()
+            if column not in self.counts and column not in self.samples:
+                if answers.nunique() > len(data) // 2:
+                    self.samples[column] = np.empty(self.reservoir_size, dtype=object)
+                    self.seen[column] = 0
+                else:
+                    self.counts[column] = Counter()
+            if column in self.counts:
+                self.counts[column].update(answers.value_counts().to_dict())
+            else:
+                self._sample(column, answers.to_numpy(dtype=object))
+
+    def _sample(self, column, answers):
+        # Reservoir sampling: the i-th answer of the column takes a random slot with probability size / (i + 1)
+        index = self.seen[column] + np.arange(len(answers))
+        slot = np.where(index < self.reservoir_size, index, (self.rng.random(len(answers)) * (index + 1)).astype(np.int64))
+        keep = slot < self.reservoir_size
+        self.samples[column][slot[keep]] = answers[keep]
+        self.seen[column] += len(answers)
+
+    def pools(self):
+        pools = {column: pd.Series(counts, dtype=np.int64) for column, counts in self.counts.items()}
+        for column, sample in self.samples.items():
+            pools[column] = pd.Series(sample[:min(self.seen[column], self.reservoir_size)]).value_counts(sort=False)
+
+        return pools
+
+
+class ChunkWriter:
+    """
+    Appends cleaned chunks to a CSV file, or to a Parquet file that read_checkpoint reads back. The Parquet columns
+    take the types seen in the first pass: text, or any column that holds objects in some chunk, as tagged strings,
+    and numeric columns as the widest type they had. The file is written under a temporary name and moved into place
+    when it is complete.
+    """
+
+    def __init__(self, path, dtypes):
+        self.path = path
+        self.partial = path + '.tmp'
+        self.rows = 0
+        self.parquet = path.endswith('.parquet')
+        if self.parquet:
+            self.tagged = [column for column, kinds in dtypes.items() if any(kind == object for kind in kinds)]
+            self.numeric = {column: np.result_type(*kinds) for column, kinds in dtypes.items() if column not in self.tagged}
+            self.schema = pa.schema([(column, pa.string() if column in self.tagged else pa.from_numpy_dtype(self.numeric[column]))
+                                     for column in dtypes], metadata={b'tagged_columns': json.dumps(self.tagged).encode()})
+            self.writer = pq.ParquetWriter(self.partial, self.schema)
+
+    def write(self, data):
+        if self.parquet:
+            data = data.astype(self.numeric)
+            self.writer.write_table(tagged_table(data, self.tagged, self.schema, preserve_index=False))
+        else:
+            data.to_csv(self.partial, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        self.rows += len(data)
+
+    def close(self):
+        if self.parquet:
+            self.writer.close()
+        os.replace(self.partial, self.path)
+        return self.rows
+
+
+def stream_clean(source, target, chunk_rows=CHUNK_ROWS, steps=SURVEY_STEPS):
+    """
+    Cleans an export chunk by chunk with the steps of the cleaning pipeline, whose stateful steps are 'rank_fix' and
+    'impute', and writes the result to target (.csv or .parquet). Returns the number of rows written.
+    """
+    names = [step.name for step in steps]
+    rank_fix, impute = steps[names.index('rank_fix')], steps[names.index('impute')]
+
+    # First pass: the steps before the imputation. The rank fix is left out, since it only changes the rank columns
+    # and RankCounts works out its effect on their pools
+    ranks = RankCounts(rank_fix.params['groups'])
+    pools, dtypes = None, {}
+    for chunk, data in enumerate(read_chunks(source, chunk_rows)):
+        for step in steps[:names.index('impute')]:
+            if step is rank_fix:
+                ranks.update(data)
+            else:
+                data = run_step(step, data, chunk)
+        if pools is None:
+            pools = AnswerPools([column for column in data.columns
+                                 if column not in impute.params['exclude'] and column not in ranks.distribution])
+        pools.update(data)
+        for column, dtype in data.dtypes.items():
+            dtypes.setdefault(column, set()).add(dtype)
+    if pools is None:
+        raise ValueError(f'{source} has no rows')
+
+    # Second pass: every step, with the state of the whole export
+    state = {rank_fix.name: {'distribution': ranks.distribution}, impute.name: {'pools': dict(pools.pools(), **ranks.pools())}}
+    writer = ChunkWriter(target, dtypes)
+    for chunk, data in enumerate(read_chunks(source, chunk_rows)):
+        for step in steps:
+            data = run_step(step, data, chunk, **state.get(step.name, {}))
+        writer.write(data)
+
+    return writer.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('Usage: python stream_cleaning.py <export csv|parquet> <output csv|parquet> [rows per chunk]')
+    rows = stream_clean(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else CHUNK_ROWS)
+    print(f'{sys.argv[1]} -> {sys.argv[2]} ({rows} rows)')
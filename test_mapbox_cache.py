@@ -0,0 +1,118 @@
+# MAPBOX CACHE TESTS
+# RouteCache against a fake session that replays a recorded Directions response, so that no test touches the network.
+# Usage: python -m pytest test_mapbox_cache.py
+
+import types
+
+import pytest
+
+import mapbox_cache
+from mapbox_cache import RouteCache, RouteCacheMiss, cache_key
+
+# Directions response for two stops, trimmed to the fields that RouteCache reads
+RECORDED_DIRECTIONS = {
+    'code': 'Ok',
+    'routes': [{'geometry': {'type': 'LineString', 'coordinates': [[103.7744, 1.2966], [103.7751, 1.2972], [103.7763, 1.2979]]},
+                'legs': [{'duration': 84.3, 'distance': 512.9}]}],
+}
+KR_TERMINAL = (103.7744, 1.2966)
+LT27 = (103.7763, 1.2979)
+UHC = (103.7765, 1.2988)
+COM3 = (103.7745, 1.2949)
+
+
+class FakeSession:
+    """Stands in for requests.Session: answers every GET with the recorded response and keeps the URLs asked for."""
+
+    def __init__(self, payload=RECORDED_DIRECTIONS):
+        self.payload = payload
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        return types.SimpleNamespace(json=lambda: self.payload)
+
+
+class Clock:
+    # Time that only moves when the test moves it, one second per reading so that last_used values never tie
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mapbox_cache, 'time', types.SimpleNamespace(time=clock.time))
+    return clock
+
+
+def make_cache(tmp_path, **kwargs):
+    kwargs.setdefault('session', FakeSession())
+    return RouteCache(path=str(tmp_path / 'route_cache.sqlite'), access_token='test', **kwargs)
+
+
+def test_hit_makes_no_network_call(tmp_path, clock):
+    cache = make_cache(tmp_path)
+    first = cache.directions([KR_TERMINAL, LT27])
+    second = cache.directions([KR_TERMINAL, LT27])
+
+    assert cache.network_calls == 1
+    assert first == second
+    assert first['durations'] == [84.3] and first['distances'] == [512.9]
+    assert first['geometry'][0] == pytest.approx((1.2966, 103.7744))
+
+
+def test_hit_from_disk_after_preload(tmp_path, clock):
+    make_cache(tmp_path).directions([KR_TERMINAL, LT27])
+
+    session = FakeSession()
+    cache = make_cache(tmp_path, session=session, offline=True)
+    assert cache.preload() == 1
+    assert cache.directions([KR_TERMINAL, LT27])['durations'] == [84.3]
+    assert session.urls == []
+
+
+def test_offline_miss_raises(tmp_path, clock):
+    session = FakeSession()
+    cache = make_cache(tmp_path, session=session, offline=True)
+
+    with pytest.raises(RouteCacheMiss):
+        cache.directions([KR_TERMINAL, LT27])
+    assert session.urls == [] and cache.network_calls == 0
+
+
+def test_key_keeps_stop_order():
+    assert cache_key('directions', 'driving', [KR_TERMINAL, LT27]) != cache_key('directions', 'driving', [LT27, KR_TERMINAL])
+    assert cache_key('directions', 'driving', [KR_TERMINAL]) == cache_key('directions', 'driving', [(103.77440000001, 1.2966)])
+
+
+def test_expired_entry_is_refetched_online_and_served_offline(tmp_path, clock):
+    cache = make_cache(tmp_path, ttl_days=1)
+    cache.directions([KR_TERMINAL, LT27])
+    clock.now += 2 * 24 * 3600
+
+    offline = make_cache(tmp_path, ttl_days=1, offline=True)
+    assert offline.directions([KR_TERMINAL, LT27])['durations'] == [84.3]
+    assert offline.network_calls == 0
+
+    cache.directions([KR_TERMINAL, LT27])
+    assert cache.network_calls == 2
+
+
+def test_eviction_drops_least_recently_used(tmp_path, clock):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.directions([KR_TERMINAL, LT27])
+    cache.directions([LT27, UHC])
+    cache.directions([KR_TERMINAL, LT27]) # read again, so the LT27 -> UHC route is now the least recently used
+    cache.directions([UHC, COM3])
+
+    assert len(cache) == 2
+    assert cache.network_calls == 3
+    cache.directions([KR_TERMINAL, LT27])
+    assert cache.network_calls == 3
+    cache.directions([LT27, UHC])
+    assert cache.network_calls == 4
@@ -0,0 +1,162 @@
+import numpy as np
+from datetime import time
+
+import registry
+
+
+def band_departures(frequencies):
+    # Departure minutes since midnight from bands of [start time, end time, freq], each band including both ends
+    departures = []
+    for start, end, freq in frequencies.values():
+        hour, minute = start.split(':')
+        first = int(hour) * 60 + int(minute)
+        hour, minute = end.split(':')
+        times = np.arange(first, int(hour) * 60 + int(minute) + 1, int(freq.rstrip('min')))
+        if len(times) and any(times[0] in earlier for earlier in departures): # dont add timings that are already in list
+            times = times[1:]
+        departures.append(times)
+
+    return np.concatenate(departures).astype(np.int16)
+
+def create_schedule(freq_dict, bus): # freq_dict is a dictionary with bus service as key and a dict of [start time, end time, freq] as values
+    # returns a dictionary with bus as key and a list of departure times (datetime object) as values
+    return {bus: [minutes_to_time(m) for m in band_departures(freq_dict[bus])]}
+
+# Departure minutes at a bus stop
+def stop_schedule(departures, minutes): # minutes is the time required to reach the bus stop from the terminal
+    return np.asarray(departures) + minutes
+
+def time_to_minutes(times):
+    # datetime.time values (or a Series of them) to minutes since midnight
+    return np.array([t.hour * 60 + t.minute + t.second / 60 for t in times], dtype=float)
+
+def minutes_to_time(minutes):
+    minutes = int(minutes) % (24 * 60)
+    return time(minutes // 60, minutes % 60)
+
+def minute_of_day(value):
+    # A datetime.time from the UI as a minute of the day; minutes are passed through
+    if isinstance(value, time):
+        return value.hour * 60 + value.minute
+    return int(value)
+
+def format_minutes(minutes):
+    # HH:MM of a minute of the day, for display
+    minutes = int(np.floor(minutes)) % (24 * 60)
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+class Timetable:
+    """
+    Departures of every service compiled once from the frequency bands and the route leg times.
+
+    departures[bus] holds the terminal departures as int16 minutes since midnight. offsets is a (service x stop) int16
+    array of minutes from the terminal to the first visit of each stop, -1 where the service does not stop, so the
+    departures from any stop are an addition and the whole day of a service is a (trip x route position) array.
+    """
+
+    def __init__(self, departures, routes, route_offsets):
+        self.services = list(departures)
+        self.departures = departures
+        self.routes = routes
+        self.route_offsets = route_offsets # bus -> int16 minutes from the terminal to every position of the route
+        self.stops = list(dict.fromkeys(stop for bus in self.services for stop in routes[bus]))
+        self.stop_index = {stop: i for i, stop in enumerate(self.stops)}
+
+        self.offsets = np.full((len(self.services), len(self.stops)), -1, dtype=np.int16)
+        for k, bus in enumerate(self.services):
+            for stop, offset in reversed(list(zip(routes[bus], route_offsets[bus]))): # first visit wins
+                self.offsets[k, self.stop_index[stop]] = offset
+
+    @classmethod
+    def compile(cls, freq_dict, routes, route_data):
+        # route_data(bus) gives the minutes from the terminal to each stop of the route
+        departures = {bus: band_departures(freq_dict[bus]) for bus in routes if bus in freq_dict}
+        offsets = {bus: route_data(bus)['minutes_from_start'].to_numpy().astype(np.int16) for bus in departures}
+
+        return cls(departures, routes, offsets)
+
+    def route_stops(self, bus):
+        return list(dict.fromkeys(self.routes[bus]))
+
+    def serves(self, stop, bus):
+        return stop in self.stop_index and self.offsets[self.services.index(bus), self.stop_index[stop]] >= 0
+
+    def stop_departures(self, stop, bus):
+        # Minutes since midnight at which the service leaves a stop
+        return stop_schedule(self.departures[bus], self.offsets[self.services.index(bus), self.stop_index[stop]])
+
+    def arrivals(self, bus):
+        # (trip x route position) minutes since midnight at which every trip of the service reaches every stop
+        return self.departures[bus][:, None] + self.route_offsets[bus][None, :]
+
+
+class DepartureIndex:
+    """
+    Sorted departure minutes (minutes since midnight, int32) of every service at every stop it serves.
+
+    All (stop, service) arrays are also kept back to back in one sorted array of pair_id * KEY_SPAN + minute keys,
+    so that the next departure for a whole column of demand rows is a single np.searchsorted call.
+    """
+
+    KEY_SPAN = 4 * 24 * 60 # larger than any departure time, including trips that run past midnight
+
+    def __init__(self, departures):
+        self.departures = departures # (stop, service) -> sorted int32 array of departure minutes
+        self.stops = sorted({stop for stop, _ in departures})
+        self.services = sorted({bus for _, bus in departures})
+        self._stop_codes = {stop: i for i, stop in enumerate(self.stops)}
+        self._service_codes = {bus: i for i, bus in enumerate(self.services)}
+
+        keys, minutes = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int32)]
+        for (stop, bus), times in departures.items():
+            pair_id = self._stop_codes[stop] * len(self.services) + self._service_codes[bus]
+            keys.append(pair_id * self.KEY_SPAN + times.astype(np.int64))
+            minutes.append(times)
+        keys, minutes = np.concatenate(keys), np.concatenate(minutes)
+        order = np.argsort(keys, kind='stable')
+        self._keys, self._minutes = keys[order], minutes[order]
+
+    @classmethod
+    def from_timetable(cls, timetable):
+        return cls({(stop, bus): np.sort(timetable.stop_departures(stop, bus).astype(np.int32))
+                    for bus in timetable.services for stop in timetable.route_stops(bus)})
+
+    @classmethod
+    def from_routes(cls, freq_dict, routes, route_data):
+        return cls.from_timetable(Timetable.compile(freq_dict, routes, route_data))
+
+    def stop_departures(self, stop, bus):
+        return self.departures[(stop, bus)]
+
+    def next_departure(self, stop, bus, minutes):
+        """
+        Returns (next departure, minutes waited) for arrivals at a stop given in minutes since midnight.
+        Both are nan when there is no later bus that day.
+        """
+        times = self.departures[(stop, bus)]
+        minutes = np.asarray(minutes, dtype=float)
+        pos = np.searchsorted(times, minutes, side='left')
+        found = pos < len(times)
+        next_bus = np.where(found, times[np.minimum(pos, len(times) - 1)], np.nan)
+
+        return next_bus, next_bus - minutes
+
+    def lookup(self, stops, services, minutes):
+        """
+        Vectorized next_departure over whole columns of stops, services and arrival minutes.
+        Rows whose stop is not served by the service get nan.
+        """
+        stop_codes = registry.positions(stops, self.stops, 'stop')
+        service_codes = registry.positions(services, self.services, 'service')
+        minutes = np.asarray(minutes, dtype=float)
+        valid = (stop_codes >= 0) & (service_codes >= 0)
+
+        pair_ids = np.where(valid, stop_codes * len(self.services) + service_codes, 0).astype(np.int64)
+        keys = pair_ids * self.KEY_SPAN + np.ceil(minutes).astype(np.int64)
+        pos = np.searchsorted(self._keys, keys, side='left')
+        pos_clipped = np.minimum(pos, len(self._keys) - 1)
+        same_pair = (pos < len(self._keys)) & (self._keys[pos_clipped] // self.KEY_SPAN == pair_ids)
+        next_bus = np.where(valid & same_pair, self._minutes[pos_clipped], np.nan)
+
+        return next_bus, next_bus - minutes
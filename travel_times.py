@@ -0,0 +1,159 @@
+import hashlib
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from config import TRAVEL_TIME_MATRIX_PATH
+
+MATRIX_BLOCK = 12 # the Mapbox Matrix API takes at most 25 coordinates per request
+ROAD_FACTOR = 1.4 # ratio of road distance to straight-line distance on campus
+FALLBACK_SPEED_KMH = 20
+
+
+def load_bus_stops(path='bus_stop_coords.csv'):
+    bus_stops = pd.read_csv(path, header=None)
+    bus_stops.rename(columns={0:"Bus Stop", 1:"lat", 2:"lon"}, inplace=True)
+
+    return bus_stops
+
+
+def haversine_seconds(lat, lon, road_factor=ROAD_FACTOR, speed_kmh=FALLBACK_SPEED_KMH):
+    # Pairwise straight-line distance scaled up to an estimated driving time
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    dlat = lat[None, :] - lat[:, None]
+    dlon = lon[None, :] - lon[:, None]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlon / 2) ** 2
+    km = 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+    return km * road_factor / speed_kmh * 3600
+
+
+def provider_seconds(bus_stops, route_cache):
+    """
+    Stop-to-stop driving times (seconds) from the Mapbox Matrix API through route_cache, in the row order of bus_stops,
+    with nan for the pairs the provider cannot answer (no route, or not cached in offline mode).
+    """
+    n = len(bus_stops)
+    seconds = np.full((n, n), np.nan)
+    coords = list(zip(bus_stops['lon'], bus_stops['lat']))
+
+    blocks = [list(range(i, min(i + MATRIX_BLOCK, n))) for i in range(0, n, MATRIX_BLOCK)]
+    for src in blocks:
+        for dst in blocks:
+            ids = src if src == dst else src + dst
+            block_coords = [coords[i] for i in ids]
+            sources = list(range(len(src)))
+            destinations = sources if src == dst else list(range(len(src), len(ids)))
+            try:
+                durations = route_cache.matrix(block_coords, sources, destinations)
+            except LookupError:
+                durations = None
+            if durations is not None:
+                seconds[np.ix_(src, dst)] = np.array(durations, dtype=float) # None becomes nan
+
+    return seconds
+
+
+def matrix_source(seconds):
+    # 'mapbox' if the provider answered every pair of different stops, 'haversine' if it answered none, else 'mixed'
+    measured = ~np.isnan(seconds[~np.eye(len(seconds), dtype=bool)])
+    return 'mapbox' if measured.all() else 'mixed' if measured.any() else 'haversine'
+
+
+def build_travel_time_matrix(bus_stops, route_cache=None, return_source=False):
+    """
+    Builds the stop-to-stop driving time matrix (seconds, float32) in the row order of bus_stops.
+    Durations come from the Mapbox Matrix API through route_cache when given; any pair the provider cannot
+    answer (no route, or not cached in offline mode) falls back to the haversine estimate. With return_source, also
+    returns where the times came from, as in matrix_source.
+    """
+    n = len(bus_stops)
+    seconds = provider_seconds(bus_stops, route_cache) if route_cache is not None else np.full((n, n), np.nan)
+    source = matrix_source(seconds)
+
+    fallback = haversine_seconds(bus_stops['lat'], bus_stops['lon'])
+    seconds = np.where(np.isnan(seconds), fallback, seconds)
+    np.fill_diagonal(seconds, 0)
+    seconds = seconds.astype(np.float32)
+
+    return (seconds, source) if return_source else seconds
+
+
+class TravelTimeMatrix:
+    """Dense stop-to-stop travel times with O(1) lookups by stop name."""
+
+    def __init__(self, stops, seconds):
+        self.stops = list(stops)
+        self.index = {stop: i for i, stop in enumerate(self.stops)}
+        self.seconds = seconds
+
+    def __contains__(self, stop):
+        return stop in self.index
+
+    def stop_indices(self, route):
+        return np.array([self.index[stop] for stop in route], dtype=np.intp)
+
+    def seconds_between(self, start, end):
+        return float(self.seconds[self.index[start], self.index[end]])
+
+    def leg_minutes(self, start, end):
+        # Whole minutes to the next stop, plus one minute spent at the stop
+        return math.ceil(self.seconds_between(start, end) / 60) + 1
+
+    def route_seconds(self, route):
+        idx = self.stop_indices(route)
+        return self.seconds[idx[:-1], idx[1:]].astype(float)
+
+    def route_leg_minutes(self, route):
+        return np.ceil(self.route_seconds(route) / 60) + 1
+
+    def route_minutes(self, route):
+        # Total driving time of the route in minutes, without time spent at stops
+        return self.route_seconds(route).sum() / 60
+
+
+def stops_hash(bus_stops):
+    # SHA-256 of the stop names and coordinates in row order, the rows and columns of the matrix
+    digest = hashlib.sha256()
+    for stop, lat, lon in zip(bus_stops['Bus Stop'], bus_stops['lat'], bus_stops['lon']):
+        digest.update(f"{stop}\t{float(lat)!r}\t{float(lon)!r}\n".encode())
+
+    return digest.hexdigest()
+
+
+def provider_available(route_cache):
+    # Whether a rebuild could ask Mapbox for driving times that are not cached yet
+    return route_cache is not None and not route_cache.offline and bool(route_cache.access_token)
+
+
+def load_travel_time_matrix(bus_stops, path=TRAVEL_TIME_MATRIX_PATH, route_cache=None, rebuild=False):
+    """
+    The matrix is built once and saved as .npy, with the hash of the stops it was built for and the source of its
+    times in a .sha256 file next to it. It is rebuilt when a stop is added, removed, renamed, moved or reordered, so
+    saved times never end up attached to the wrong stops, and when some of its times are haversine estimates and
+    Mapbox can be asked for driving times.
+    """
+    n = len(bus_stops)
+    source_hash = stops_hash(bus_stops)
+    hash_path = path + '.sha256' if path else None
+    seconds = None
+    if not rebuild and path and os.path.exists(path) and os.path.exists(hash_path):
+        with open(hash_path) as f:
+            saved = f.read().split()
+        saved_hash, saved_source = (saved + ['haversine'])[:2] if saved else (None, None)
+        if saved_hash == source_hash and (saved_source == 'mapbox' or not provider_available(route_cache)):
+            seconds = np.load(path)
+            if seconds.shape != (n, n):
+                seconds = None
+
+    if seconds is None:
+        seconds, source = build_travel_time_matrix(bus_stops, route_cache, return_source=True)
+        if path:
+            np.save(path, seconds)
+            with open(hash_path, 'w') as f:
+                f.write(f'{source_hash} {source}\n')
+
+    return TravelTimeMatrix(bus_stops['Bus Stop'], seconds)